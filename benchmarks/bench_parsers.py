@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Checks the courier parsers against the recorded fixtures and reports
+how long each takes per page, for every available HTML backend.
+
+    python -m benchmarks.bench_parsers [--number 200]
+"""
+from marvinbot_package_tracker_plugin.parsers import HAS_LXML, PARSERS, format_events
+from benchmarks import fixture
+import argparse
+import sys
+import timeit
+
+CASES = [
+    ('grid', 'grid.html', 'grid.expected.txt'),
+    ('grid', 'grid_empty.html', 'grid_empty.expected.txt'),
+    ('labels', 'labels.html', 'labels.expected.txt'),
+]
+
+CONFIG = {
+    'response_format': '{date} {time}: {status} @ {loc}',
+    'response_format_noloc': '{date} {time}: {status}',
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=200, help='Parses per measurement.')
+    args = parser.parse_args(argv)
+
+    backends = ['html.parser'] + (['lxml'] if HAS_LXML else [])
+    failures = 0
+    print('{:<8} {:<20} {:<12} {:>12}'.format('parser', 'fixture', 'backend', 'us/page'))
+    for parser_name, page, expected in CASES:
+        text = fixture(page)
+        expected = fixture(expected).rstrip('\n')
+        for backend in backends:
+            config = dict(CONFIG, html_parser=backend)
+            parse = PARSERS[parser_name]
+            if format_events(parse(text, config), config) != expected:
+                print('{:<8} {:<20} {:<12} {:>12}'.format(parser_name, page, backend, 'MISMATCH'))
+                failures += 1
+                continue
+            best = min(timeit.repeat(lambda: parse(text, config), number=args.number, repeat=3))
+            print('{:<8} {:<20} {:<12} {:>12.1f}'.format(parser_name, page, backend, best / args.number * 1e6))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
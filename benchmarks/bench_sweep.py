@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Measures end-to-end process_tracked_packages throughput against the stub
+courier server, with TrackedPackage backed by mongomock.
+
+    python -m benchmarks.bench_sweep [--sizes 100 1000 10000] [--latency 0.05] [--error-rate 0.01] [--profile]
+
+Each size is swept twice: a cold sweep where every page is new, and a warm
+sweep over the same, unchanged pages.
+"""
+from marvinbot_package_tracker_plugin.base import PackageTrackerPlugin, process_tracked_packages
+from marvinbot_package_tracker_plugin.metrics import format_profile
+from marvinbot_package_tracker_plugin.models import TrackedPackage
+from benchmarks.stub_server import StubCourierServer
+import argparse
+import mongoengine
+import mongomock
+import re
+import sys
+import threading
+import time
+
+# Tracking number templates matching the default courier patterns
+TRACKING_NUMBERS = {
+    'BMCargo': 'WR01-01{:07d}',
+    'Aeropaq': 'WR02-{:07d}',
+    'Caripack': 'G02-{:010d}',
+    'Liberty Express': 'WR01-30{:07d}',
+    'PickN\'Send': 'WR13-{:09d}',
+    'DomEX': 'WR01-000{:06d}',
+}
+
+
+class RecordingBot(object):
+    def __init__(self):
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def sendMessage(self, *args, **kwargs):
+        with self._lock:
+            self.sent += 1
+
+
+class BenchAdapter(object):
+    def __init__(self):
+        self.bot = RecordingBot()
+
+
+def make_plugin(server, **overrides):
+    plugin = PackageTrackerPlugin()
+    config = plugin.get_default_config()
+    for courier in config['couriers']:
+        slug = re.sub(r'\W', '', courier['name']).lower()
+        courier['baseurl'] = server.base_url(slug, courier['parser'])
+    config.update({
+        'cache_ttl': 0,
+        'http_max_retries': 0,
+        'notify_rate': 1000000,
+        'notify_chat_interval': 0,
+        'metrics_sinks': [],
+        # mongomock has no $mod; a single shard sweeps everything without it
+        'sweep_shards': 1,
+        # Measure full speed rather than pacing across process_interval
+        'sweep_spread': 0,
+    })
+    config.update(overrides)
+    plugin.configure(config)
+    plugin.adapter = BenchAdapter()
+    process_tracked_packages.plugin = plugin
+    return plugin
+
+
+def seed(count):
+    TrackedPackage.drop_collection()
+    names = sorted(TRACKING_NUMBERS)
+    documents = []
+    for i in range(count):
+        courier = names[i % len(names)]
+        documents.append({
+            '_id': i + 1,
+            'tracking_number': TRACKING_NUMBERS[courier].format(i),
+            'courier': courier,
+            'subscribers': [1000 + i % 50],
+        })
+    TrackedPackage._get_collection().insert_many(documents)
+
+
+def sweep():
+    started = time.perf_counter()
+    process_tracked_packages()
+    elapsed = time.perf_counter() - started
+    process_tracked_packages.plugin.notifier.drain(timeout=60)
+    return elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--latency', type=float, default=0.0, help='Stub response latency in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of stub requests that fail.')
+    parser.add_argument('--workers', type=int, default=None, help='Overrides max_workers.')
+    parser.add_argument('--profile', action='store_true', help='Prints the profile of every sweep.')
+    args = parser.parse_args(argv)
+
+    mongoengine.connect('package_tracker_bench', mongo_client_class=mongomock.MongoClient)
+    overrides = {'max_workers': args.workers} if args.workers else {}
+
+    print('{:>8} {:<6} {:>10} {:>12} {:>10} {:>10}'.format('packages', 'sweep', 'seconds', 'packages/s', 'requests', 'messages'))
+    with StubCourierServer(latency=args.latency, error_rate=args.error_rate, seed=0) as server:
+        for size in args.sizes:
+            plugin = make_plugin(server, **overrides)
+            seed(size)
+            for label in ('cold', 'warm'):
+                if label == 'warm':
+                    # Make every package due again
+                    TrackedPackage.objects.update(set__next_check_at=None)
+                requests_before, sent_before = server.requests, plugin.adapter.bot.sent
+                elapsed = sweep()
+                print('{:>8} {:<6} {:>10.2f} {:>12.1f} {:>10} {:>10}'.format(
+                    size, label, elapsed, size / elapsed,
+                    server.requests - requests_before, plugin.adapter.bot.sent - sent_before))
+                if args.profile:
+                    print(format_profile(plugin.profiles.latest))
+            plugin.notifier.stop()
+            plugin.http.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
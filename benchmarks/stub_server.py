@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from benchmarks import fixture
+import random
+import threading
+import time
+import uuid
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubCourierServer(object):
+    """Imitates the couriers' estatus.aspx endpoints on localhost.
+
+    Every courier is served under its own path prefix (see `base_url`).
+    Responses are the recorded fixtures with fresh view state on each
+    request, delayed by `latency` seconds; a fraction `error_rate` of the
+    requests fails with a 500. Tracking numbers listed in `empty_ids` get an
+    empty grid, like an unknown tracking number would."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.empty_ids = set()
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._pages = {
+            'grid': fixture('grid.html'),
+            'labels': fixture('labels.html'),
+            'empty': fixture('grid_empty.html'),
+        }
+        self._server = None
+        self._thread = None
+
+    def base_url(self, slug, parser='grid'):
+        return 'http://127.0.0.1:{}/{}/{}/zz/estatus.aspx'.format(self.port, slug, parser)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle(self, request):
+        url = urlparse(request.path)
+        parts = url.path.strip('/').split('/')
+        tracking_number = parse_qs(url.query).get('id', [''])[0]
+        with self._lock:
+            self.requests += 1
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if failed:
+            status, body = 500, 'Server Error'
+        elif len(parts) < 2 or parts[1] not in self._pages:
+            status, body = 404, 'Not Found'
+        else:
+            page = 'empty' if tracking_number in self.empty_ids else parts[1]
+            status = 200
+            body = (self._pages[page]
+                    .replace('__VIEWSTATE__', uuid.uuid4().hex)
+                    .replace('__EVENTVALIDATION__', uuid.uuid4().hex))
+
+        payload = body.encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'text/html; charset=utf-8')
+        request.send_header('Content-Length', str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
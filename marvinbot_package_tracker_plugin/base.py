@@ -4,22 +4,94 @@ from marvinbot.handlers import CommandHandler, CallbackQueryHandler
 from marvinbot.signals import plugin_reload
 from marvinbot.plugins import Plugin
 from marvinbot.models import User
-from marvinbot_package_tracker_plugin.models import TrackedPackage
+from marvinbot_package_tracker_plugin.models import SweepCheckpoint, SweepLease, TrackedPackage
+from marvinbot_package_tracker_plugin.breaker import CircuitBreakers
+from marvinbot_package_tracker_plugin.cache import LookupCache
+from marvinbot_package_tracker_plugin.couriers import DEFAULT_COURIERS, CourierDispatcher, apply_legacy_config, load_couriers
+from marvinbot_package_tracker_plugin.fetcher import CourierFetcher
+from marvinbot_package_tracker_plugin.metrics import LogSink, MemorySink, Metrics, PrometheusSink, format_profile, since
+from marvinbot_package_tracker_plugin.migrations import backfill_couriers
+from marvinbot_package_tracker_plugin.notifier import Notifier
+from marvinbot_package_tracker_plugin.parsers import event_key, format_event, format_events
+from marvinbot_package_tracker_plugin.persistence import BulkWriter
+from marvinbot_package_tracker_plugin.polling import next_check_at
+from marvinbot_package_tracker_plugin.retention import archive_deleted_packages, purge_archived_packages
+from marvinbot_package_tracker_plugin.scheduling import Pacer, SingleFlight
+from marvinbot_package_tracker_plugin.sessions import SessionPool
+from marvinbot_package_tracker_plugin.workers import UserWorkPool
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-from bs4 import BeautifulSoup
+from collections import OrderedDict
+from datetime import timedelta
+from functools import partial
+import atexit
+import hashlib
 import logging
+import os
+import random
 import re
-import requests
+import socket
+import time
+import uuid
 
 log = logging.getLogger(__name__)
 
+UNCHANGED = object()
+"""Lookup result for a status page that hasn't changed since it was last processed."""
+
+SKIPPED = object()
+"""Lookup result when the courier's circuit breaker is open and no request was made."""
+
+UNRESOLVED = '*'
+"""Sweep checkpoint key for packages without a known courier."""
+
+MAX_MESSAGE_LENGTH = 4096
+
+INSTANCE_LEASE_PREFIX = 'instance:'
+"""SweepLease name prefix instances announce themselves with."""
+
+VOLATILE_INPUT = re.compile(r'<input[^>]+type="hidden"[^>]*>', flags=re.IGNORECASE)
+
+
+def page_fingerprint(content):
+    # ASP.NET view state and friends change on every request, leave them out
+    return hashlib.sha1(VOLATILE_INPUT.sub('', content).encode('utf-8')).hexdigest()
+
+
+def new_events(trackedPackage, events, config):
+    """Splits page events into those not stored on `trackedPackage` yet and
+    those its subscribers haven't been told about yet."""
+    seen = set(event_key(event.to_event()) for event in trackedPackage.events)
+    # Packages tracked before events were stored only have the formatted updates
+    notified = set(trackedPackage.updates.split("\n")) if not seen and trackedPackage.updates else set()
+    unstored = []
+    for event in events:
+        key = event_key(event)
+        if key not in seen:
+            seen.add(key)
+            unstored.append(event)
+    return unstored, [event for event in unstored if format_event(event, config) not in notified]
+
 
 class PackageTrackerPlugin(Plugin):
     def __init__(self):
         super(PackageTrackerPlugin, self).__init__('package_tracker')
         self.couriers = []
+        self.dispatcher = None
+        self.fetcher = None
+        self.http = None
+        self.cache = None
+        self.notifier = None
+        self.breakers = None
+        self.workers = None
+        self.metrics = Metrics()
+        self.profiles = MemorySink()
+        self.sinks = []
+        # Identifies this process when leasing sweep shards
+        self.instance_id = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
         self.config = None
         self.bot = None
+        self.instance_leased = False
+        atexit.register(self.release_instance_lease)
 
     def get_default_config(self):
         return {
@@ -29,248 +101,231 @@ class PackageTrackerPlugin(Plugin):
             'process_interval': {"minutes": 15},
             'max_num_errors': 10,   # Max consecutive errors before deletion
             'max_days_stalled': 7,  # Max days without updates before deletion
+            'min_check_interval': {"minutes": 10},  # Poll interval for recently updated packages, below process_interval
+            'max_check_interval': {"hours": 6},  # Poll interval cap for stalled or failing packages
+            'check_backoff_factor': 0.1,  # Fraction of the time since the last update to wait
+            'sweep_batch_size': 100,  # Packages per bulk write during a sweep
+            'sweep_shards': 4,  # Sweep work units, leased by whichever bot instance gets to them first
+            'sweep_lease_ttl': 600,  # Seconds before a crashed instance's shards are taken over
+            'sweep_overlap': 'skip',  # When a sweep is still running at the next interval: 'skip' or 'coalesce' into one rerun
+            'sweep_spread': 0.8,  # Fraction of process_interval to pace fetches over, across all instances; 0 for full speed
+            'check_jitter': 0.1,  # Max random fraction taken off every package's next check delay
+            'retention_interval': {"hours": 24},  # How often deleted packages are compacted
+            'retention_days': 30,  # Days deleted packages are kept in full before being archived
+            'archive_retention_days': 365,  # Days archived numbers stay unsubscribable, None for ever
+            'max_workers': 8,  # Max concurrent courier fetches per sweep
+            'max_workers_per_courier': 2,  # Max concurrent fetches against a single courier
+            'http_pool_size': 4,  # Keep-alive connections per courier
+            'http_connect_timeout': 5,  # Seconds
+            'http_read_timeout': 15,  # Seconds
+            'http_max_retries': 2,
+            'http_backoff_factor': 0.5,
+            'breaker_failure_threshold': 5,  # Consecutive failures before a courier is skipped
+            'breaker_reset_timeout': 300,  # Seconds before retrying a skipped courier
+            'cache_ttl': 60,  # Seconds a successful lookup is reused, 0 to disable
+            'cache_max_size': 1024,  # Max cached lookups
+            'command_workers': 4,  # Threads serving /track lookups and subscription buttons
+            'max_lookups_per_user': 2,  # Max in-flight lookups per user
+            'max_bulk_track': 20,  # Max tracking numbers per /track command
+            'notify_rate': 30,  # Max update notifications sent per second
+            'notify_chat_interval': 1.0,  # Min seconds between notifications to the same chat
+            'notify_max_attempts': 5,  # Attempts per notification when rate limited
+            'metrics_sinks': ['log'],  # Where sweep profiles go besides /sweepstats: 'log' and/or 'prometheus'
+            'metrics_host': '127.0.0.1',  # Address the prometheus sink serves /metrics on
+            'metrics_port': 9105,
+            'html_parser': 'auto',  # 'lxml', 'html.parser' or 'auto' (lxml when installed)
             'response_format': '{date} {time}: {status} @ {loc}',
             'response_format_noloc': '{date} {time}: {status}',
-            'bmcargo_baseurl': 'http://erp-online.bmcargo.com/zz/estatus.aspx',
-            'bmcargo_pattern': r'^WR01-01\d{7}$',
-            'aeropaq_baseurl': 'http://erp-online.aeropaq.com/zz/estatus.aspx',
-            'aeropaq_pattern': r'^WR02-\d{7}$',
-            'caripack_baseurl': 'http://erp-online.caripack.com/zz/estatus.aspx',
-            'caripack_pattern': r'^G02-\d{10}$',
-            'liberty_baseurl': 'http://online.libertyexpress.com/zz/estatus.aspx',
-            'liberty_pattern': r'^WR01-30\d{7}$',
-            'picknsend_baseurl': 'http://online.picknsend.com/zz/estatus.aspx',
-            'picknsend_pattern': r'^WR13-\d{9}$',
-            'domex_baseurl': 'https://domex-online.iplus.com.do/zz/estatus.aspx',
-            'domex_pattern': r'^WR01-000\d{6}$',
+            'couriers': [dict(courier) for courier in DEFAULT_COURIERS],
         }
 
     def configure(self, config):
-        self.couriers = [
-            {
-                'name': 'BMCargo',
-                'handler': self.handle_bmcargo,
-                'pattern': re.compile(config.get('bmcargo_pattern'),
-                                      flags=re.IGNORECASE)
-            },
-            {
-                'name': 'Aeropaq',
-                'handler': self.handle_aeropaq,
-                'pattern': re.compile(config.get('aeropaq_pattern'),
-                                      flags=re.IGNORECASE)
-            },
-            {
-                'name': 'Caripack',
-                'handler': self.handle_caripack,
-                'pattern': re.compile(config.get('caripack_pattern'),
-                                      flags=re.IGNORECASE)
-            },
-            {
-                'name': 'Liberty Express',
-                'handler': self.handle_liberty,
-                'pattern': re.compile(config.get('liberty_pattern'),
-                                      flags=re.IGNORECASE)
-            },
-            {
-                'name': 'PickN\'Send',
-                'handler': self.handle_picknsend,
-                'pattern': re.compile(config.get('picknsend_pattern'),
-                                      flags=re.IGNORECASE)
-            },
-            {
-                'name': 'DomEX',
-                'handler': self.handle_domex,
-                'pattern': re.compile(config.get('domex_pattern'),
-                                      flags=re.IGNORECASE)
-            }
-        ]
+        self.couriers = load_couriers(apply_legacy_config(config))
+        for courier in self.couriers:
+            courier['handler'] = partial(self.handle_courier, courier)
+        self.dispatcher = CourierDispatcher(self.couriers)
+        self.fetcher = CourierFetcher(config.get('max_workers'),
+                                      config.get('max_workers_per_courier'))
+        if self.http is not None:
+            self.http.close()
+        self.http = SessionPool(pool_size=config.get('http_pool_size'),
+                                connect_timeout=config.get('http_connect_timeout'),
+                                read_timeout=config.get('http_read_timeout'),
+                                max_retries=config.get('http_max_retries'),
+                                backoff_factor=config.get('http_backoff_factor'))
+        self.cache = LookupCache(ttl=config.get('cache_ttl'),
+                                 max_size=config.get('cache_max_size'),
+                                 cacheable=lambda value: value[1] == 200)
+        if self.workers is not None:
+            self.workers.shutdown()
+        self.workers = UserWorkPool(max_workers=config.get('command_workers'),
+                                    max_per_user=config.get('max_lookups_per_user'))
+        self.breakers = CircuitBreakers(failure_threshold=config.get('breaker_failure_threshold'),
+                                        reset_timeout=config.get('breaker_reset_timeout'))
+        if self.notifier is not None:
+            self.notifier.stop()
+        self.notifier = Notifier(self.send_notification,
+                                 rate=config.get('notify_rate'),
+                                 chat_interval=config.get('notify_chat_interval'),
+                                 max_attempts=config.get('notify_max_attempts'),
+                                 metrics=self.metrics)
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = [self.profiles]
+        for name in config.get('metrics_sinks') or []:
+            if name == 'log':
+                self.sinks.append(LogSink())
+            elif name == 'prometheus':
+                try:
+                    self.sinks.append(PrometheusSink(self.metrics, config.get('metrics_host'), config.get('metrics_port')))
+                except OSError as err:
+                    log.error('Unable to serve metrics: {}'.format(err))
+            else:
+                log.warning('Unknown metrics sink: {}'.format(name))
+        # The next sweep announces this instance again, with the new process_interval
+        self.release_instance_lease()
         self.config = config
 
+    def acquire_instance_lease(self, ttl):
+        """Announces this instance to the others for `ttl` seconds."""
+        SweepLease.acquire(INSTANCE_LEASE_PREFIX + self.instance_id, self.instance_id, ttl)
+        self.instance_leased = True
+
+    def release_instance_lease(self):
+        """Withdraws this instance's announcement, on reconfiguration and at exit."""
+        if not self.instance_leased:
+            return
+        try:
+            SweepLease.release(INSTANCE_LEASE_PREFIX + self.instance_id, self.instance_id)
+            self.instance_leased = False
+        except Exception as err:
+            log.error('Unable to release instance lease: {}'.format(err))
+
     def setup_handlers(self, adapter):
         self.add_handler(CommandHandler('track', self.on_track_command, command_description='Allows the user to track couriers packages.')
-                         .add_argument('id', help='Tracking number (e.g. WR01-001231234).'))
+                         .add_argument('ids', nargs='+', help='Tracking numbers (e.g. WR01-001231234).')
+                         .add_argument('--subscribe', action='store_true', help='Subscribe to updates for every tracking number.'))
+        self.add_handler(CommandHandler('couriers', self.on_couriers_command, command_description='Shows supported couriers and their availability.'))
+        self.add_handler(CommandHandler('sweepstats', self.on_sweepstats_command, command_description='Shows the profile of the latest package sweep (admins only).'))
         self.add_handler(CallbackQueryHandler('{}:subscribe'.format(self.name), self.on_subscribe_button))
         self.add_handler(CallbackQueryHandler('{}:unsubscribe'.format(self.name), self.on_unsubscribe_button))
 
     def setup_schedules(self, adapter):
         process_tracked_packages.plugin = self
-        interval = self.config.get('process_interval')
-        job = self.adapter.add_job(process_tracked_packages, 'interval', **interval,
-                                   id='process_tracked_packages', name='Fetches tracked packages for processing.',
-                                   replace_existing=True)
-
-    def handle_bmcargo(self, tracking_number):
-        base_url = self.config.get('bmcargo_baseurl')
-        params = {'id': tracking_number}
-        r = requests.get(base_url, params=params)
-        if r.status_code != 200:
-            return [None, r.status_code]
-
-        soup = BeautifulSoup(r.text, 'html.parser')
-        responses = []
-        try:
-            for td in soup.select("td[class=dxgv]"):
-                first_div, second_div = td.select("div")
-                status = first_div.select_one("span").contents[0]
-                date = second_div.contents[0].strip().replace('.', '-')
-                time = second_div.contents[2].strip().upper()
-
-                if len(second_div.contents) >= 4:
-                    response_format = self.config.get('response_format')
-                    loc = second_div.contents[4].strip() if len(second_div.contents) >= 4 else 'Desconocido'
-                    response = response_format.format(status=status, date=date, time=time, loc=loc)
-                else:
-                    response_format = self.config.get('response_format_noloc')
-                    response = response_format.format(status=status, date=date, time=time)
-                responses.append(response)
-        except Exception as err:
-            log.error("Parse error: {}".format(err))
-
-        return ["\n".join(responses), r.status_code]
-
-    def handle_aeropaq(self, tracking_number):
-        base_url = self.config.get('aeropaq_baseurl')
-        params = {'id': tracking_number}
-        r = requests.get(base_url, params=params)
-        if r.status_code != 200:
-            return [None, r.status_code]
-
-        soup = BeautifulSoup(r.text, 'html.parser')
-        responses = []
         try:
-            for td in soup.select("td[class=dxgv]"):
-                first_div, second_div = td.select("div")
-                status = first_div.select_one("span").contents[0]
-                date = second_div.contents[0].strip().replace('.', '-')
-                time = second_div.contents[2].strip().upper()
-
-                if len(second_div.contents) >= 4:
-                    response_format = self.config.get('response_format')
-                    loc = second_div.contents[4].strip() if len(second_div.contents) >= 4 else 'Desconocido'
-                    response = response_format.format(status=status, date=date, time=time, loc=loc)
-                else:
-                    response_format = self.config.get('response_format_noloc')
-                    response = response_format.format(status=status, date=date, time=time)
-                responses.append(response)
+            backfill_couriers(self.dispatcher)
         except Exception as err:
-            log.error("Parse error: {}".format(err))
-
-        return ["\n".join(responses), r.status_code]
-
-    def handle_liberty(self, tracking_number):
-        base_url = self.config.get('liberty_baseurl')
-        params = {'id': tracking_number}
-        r = requests.get(base_url, params=params)
-        if r.status_code != 200:
-            return [None, r.status_code]
-
-        soup = BeautifulSoup(r.text, 'html.parser')
-        responses = []
-        try:
-            for td in soup.select("td[class=dxgv]"):
-                first_div, second_div = td.select("div")
-                status = first_div.select_one("span").contents[0]
-                date = second_div.contents[0].strip().replace('.', '-')
-                time = second_div.contents[2].strip().upper()
-
-                if len(second_div.contents) >= 4:
-                    response_format = self.config.get('response_format')
-                    loc = second_div.contents[4].strip() if len(second_div.contents) >= 4 else 'Desconocido'
-                    response = response_format.format(status=status, date=date, time=time, loc=loc)
-                else:
-                    response_format = self.config.get('response_format_noloc')
-                    response = response_format.format(status=status, date=date, time=time)
-                responses.append(response)
-        except Exception as err:
-            log.error("Parse error: {}".format(err))
-
-        return ["\n".join(responses), r.status_code]
-
-    def handle_caripack(self, tracking_number):
-        base_url = self.config.get('caripack_baseurl')
-        params = {'id': tracking_number}
-        r = requests.get(base_url, params=params)
-        if r.status_code != 200:
-            return [None, r.status_code]
-
-        soup = BeautifulSoup(r.text, 'html.parser')
-        responses = []
-        try:
-            for td in soup.select("td[class=dxgv]"):
-                first_div, second_div = td.select("div")
-                status = first_div.select_one("span").contents[0]
-                date = second_div.contents[0].strip().replace('.', '-')
-                time = second_div.contents[2].strip().upper()
-
-                if len(second_div.contents) >= 4:
-                    response_format = self.config.get('response_format')
-                    loc = second_div.contents[4].strip() if len(second_div.contents) >= 4 else 'Desconocido'
-                    response = response_format.format(status=status, date=date, time=time, loc=loc)
-                else:
-                    response_format = self.config.get('response_format_noloc')
-                    response = response_format.format(status=status, date=date, time=time)
-                responses.append(response)
-        except Exception as err:
-            log.error("Parse error: {}".format(err))
-
-        return ["\n".join(responses), r.status_code]
-
-    def handle_picknsend(self, tracking_number):
-        base_url = self.config.get('picknsend_baseurl')
-        params = {'id': tracking_number}
-        r = requests.get(base_url, params=params)
+            log.error('Unable to backfill tracked package couriers: {}'.format(err))
+        SWEEP.policy = self.config.get('sweep_overlap')
+        interval = self.config.get('process_interval')
+        # Runs that misfired while the scheduler was busy collapse into one; overlapping
+        # runs are let through so SWEEP can skip or coalesce them and log it
+        job = self.adapter.add_job(run_sweep, 'interval', **interval,
+                                   id='process_tracked_packages', name='Fetches tracked packages for processing.',
+                                   coalesce=True, max_instances=2, replace_existing=True)
+        compact_tracked_packages.plugin = self
+        self.adapter.add_job(compact_tracked_packages, 'interval', **self.config.get('retention_interval'),
+                             id='compact_tracked_packages', name='Archives and purges deleted tracked packages.',
+                             coalesce=True, max_instances=1, replace_existing=True)
+
+    def courier_health(self):
+        """Returns the circuit breaker state of every courier, by name."""
+        health = self.breakers.snapshot()
+        return {courier['name']: health.get(courier['name'], {'state': 'closed', 'failures': 0, 'retry_in': None})
+                for courier in self.couriers}
+
+    def publish_profile(self, profile):
+        for sink in self.sinks:
+            try:
+                sink.publish(profile)
+            except Exception as err:
+                log.error('Unable to publish sweep profile to {}: {}'.format(type(sink).__name__, err))
+
+    def send_notification(self, chat_id, text, **kwargs):
+        self.adapter.bot.sendMessage(chat_id=chat_id, text=text, **kwargs)
+
+    def resolve_courier(self, tracking_number):
+        """Returns the courier that handles `tracking_number`, or None."""
+        return self.dispatcher.resolve(tracking_number)
+
+    def request_page(self, courier, tracking_number, headers=None):
+        """Returns the courier's response, None if the request failed, or
+        SKIPPED without a request while the courier's circuit is open."""
+        breaker = self.breakers.get(courier['name'])
+        if not breaker.allow():
+            self.metrics.inc('courier_skipped_total', courier=courier['name'])
+            return SKIPPED
+        # Sweep, bulk and single lookups share the per-courier limit
+        with self.fetcher.slot(courier['name']):
+            started = time.perf_counter()
+            try:
+                r = self.http.get(courier['baseurl'], params={'id': tracking_number}, headers=headers)
+            except Exception as err:
+                # Anything short of a response counts against the courier, or a
+                # half-open probe would never be settled
+                log.error("Request to {} for {} failed: {}".format(courier['name'], tracking_number, err))
+                self.metrics.inc('courier_responses_total', courier=courier['name'], status='error')
+                breaker.record(False)
+                return None
+            finally:
+                self.metrics.observe('courier_fetch_seconds', time.perf_counter() - started, courier=courier['name'])
+        self.metrics.inc('courier_responses_total', courier=courier['name'], status=str(r.status_code))
+        breaker.record(r.status_code < 500 and r.status_code != 429)
+        return r
+
+    def parse_page(self, courier, text):
+        with self.metrics.timer('courier_parse_seconds', courier=courier['name']):
+            return courier['parser'](text, self.config)
+
+    def handle_courier(self, courier, tracking_number):
+        # Identical lookups share one request and reuse fresh results
+        key = (courier['name'], tracking_number.upper())
+        return self.cache.get_or_fetch(key, partial(self.fetch_courier, courier, tracking_number))
+
+    def fetch_courier(self, courier, tracking_number):
+        r = self.request_page(courier, tracking_number)
+        if r is None or r is SKIPPED:
+            return [None, None]
         if r.status_code != 200:
             return [None, r.status_code]
 
-        soup = BeautifulSoup(r.text, 'html.parser')
-        responses = []
-        try:
-            labels = soup.select("td[class=dxgv] label")
-            label_pairs = [labels[i:i + 2] for i in range(0, len(labels), 2)]
-            for first_label, second_label in label_pairs:
-                status = first_label.contents[0]
-                st, loc, datetime = [x.strip() for x in second_label.contents[0].split(',')]
-                date, time = [x.strip() for x in datetime.split('|')]
-                date = date.replace('.', '-')
-                time = time.upper()
-                loc = loc.upper()
-                response_format = self.config.get('response_format')
-                response = response_format.format(status=status, date=date, time=time, loc=loc)
-                responses.append(response)
-        except Exception as err:
-            log.error("Parse error: {}".format(err))
+        return [self.parse_page(courier, r.text), r.status_code]
 
-        return ["\n".join(responses), r.status_code]
+    def check_courier(self, courier, trackedPackage):
+        """Looks up `trackedPackage` for the sweep.
 
-    def handle_domex(self, tracking_number):
-        base_url = self.config.get('domex_baseurl')
-        params = {'id': tracking_number}
-        r = requests.get(base_url, params=params)
+        Returns [events, status, validators]. A fresh cached lookup is reused
+        as is; otherwise the page is fetched conditionally and events is
+        UNCHANGED, without parsing, when it matches the stored fingerprint,
+        or SKIPPED when the courier's circuit is open."""
+        tracking_number = trackedPackage.tracking_number
+        cached = self.cache.get((courier['name'], tracking_number.upper()))
+        if cached is not None:
+            return [cached[0], cached[1], {}]
+
+        headers = {}
+        if trackedPackage.etag:
+            headers['If-None-Match'] = trackedPackage.etag
+        if trackedPackage.last_modified:
+            headers['If-Modified-Since'] = trackedPackage.last_modified
+        r = self.request_page(courier, tracking_number, headers=headers)
+        if r is SKIPPED:
+            return [SKIPPED, None, {}]
+        if r is None:
+            return [None, None, {}]
+        if r.status_code == 304:
+            return [UNCHANGED, 200, {}]
         if r.status_code != 200:
-            return [None, r.status_code]
-
-        soup = BeautifulSoup(r.text, 'html.parser')
-        responses = []
-        try:
-            for td in soup.select("td[class=dxgv]"):
-                first_div, second_div = td.select("div")
-                status = first_div.select_one("span").contents[0]
-                date = second_div.contents[0].strip().replace('.', '-')
-                time = second_div.contents[2].strip().upper()
-
-                if len(second_div.contents) >= 4:
-                    response_format = self.config.get('response_format')
-                    loc = second_div.contents[4].strip() if len(second_div.contents) >= 4 else 'Desconocido'
-                    response = response_format.format(status=status, date=date, time=time, loc=loc)
-                else:
-                    response_format = self.config.get('response_format_noloc')
-                    response = response_format.format(status=status, date=date, time=time)
-                responses.append(response)
-        except Exception as err:
-            log.error("Parse error: {}".format(err))
-
-        return ["\n".join(responses), r.status_code]
+            return [None, r.status_code, {}]
 
+        validators = {
+            'content_hash': page_fingerprint(r.text),
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+        }
+        if validators['content_hash'] == trackedPackage.content_hash:
+            return [UNCHANGED, 200, validators]
+        return [self.parse_page(courier, r.text), 200, validators]
 
     @classmethod
     def add_tracked_package(cls, *args, **kwargs):
@@ -290,60 +345,38 @@ class PackageTrackerPlugin(Plugin):
             return None
 
     def subscribe(self, tracking_number, user_id, notify=False):
-        def do_notify():
-            self.adapter.bot.sendMessage(chat_id=user_id,
-                                         text="✅ You are now subscribed to receive updates for {}.".format(tracking_number))
-
-        tp = TrackedPackage.by_tracking_number(tracking_number)
-        if tp is None:
-            subscribers = [user_id]
-            tp = TrackedPackage(tracking_number=tracking_number,
-                                subscribers=subscribers)
-            tp.save()
-            if notify:
-                do_notify()
-            return True
-        elif tp.date_deleted is None:
-            if user_id not in tp.subscribers:
-                tp.subscribers.append(user_id)
-                tp.save()
-                if notify:
-                    do_notify()
-                return True
+        courier = self.resolve_courier(tracking_number)
+        subscribed = TrackedPackage.add_subscriber(tracking_number, user_id, courier['name'] if courier else None)
+        if notify:
+            if subscribed:
+                text = "✅ You are now subscribed to receive updates for {}.".format(tracking_number)
+            elif subscribed is None:
+                text = "❌ You can no longer subscribe to this package."
             else:
-                if notify:
-                    self.adapter.bot.sendMessage(chat_id=user_id,
-                                                 text="❌ You are already subscribed.")
-        else:
-            if notify:
-                self.adapter.bot.sendMessage(chat_id=user_id,
-                                             text="❌ You can no longer subscribe to this package.")
-        return False
+                text = "❌ You are already subscribed."
+            self.adapter.bot.sendMessage(chat_id=user_id, text=text)
+        return bool(subscribed)
 
     def unsubscribe(self, tracking_number, user_id, notify=False):
-        tp = TrackedPackage.by_tracking_number(tracking_number)
-        if tp is None or tp.date_deleted is not None:
-            if notify:
-                self.adapter.bot.sendMessage(chat_id=user_id,
-                                             text="❌ Tracked package does not exist or was deleted.")
-        else:
-            if user_id not in tp.subscribers:
-                if notify:
-                    self.adapter.bot.sendMessage(chat_id=user_id,
-                                                 text="❌ You are not subscribed to {}.".format(tracking_number))
+        unsubscribed = TrackedPackage.remove_subscriber(tracking_number, user_id)
+        if notify:
+            if unsubscribed:
+                text = "🚮 You are now unsubscribed from receiving updates for {}.".format(tracking_number)
+            elif unsubscribed is None:
+                text = "❌ Tracked package does not exist or was deleted."
             else:
-                tp.subscribers = [subscriber for subscriber in tp.subscribers if subscriber != user_id]
-                tp.save()
-                if notify:
-                    self.adapter.bot.sendMessage(chat_id=user_id,
-                                                 text="🚮 You are now unsubscribed from receiving updates for {}.".format(tracking_number))
-                return True
-        return False
+                text = "❌ You are not subscribed to {}.".format(tracking_number)
+            self.adapter.bot.sendMessage(chat_id=user_id, text=text)
+        return bool(unsubscribed)
 
     def on_unsubscribe_button(self, update, *args, **kwargs):
         query = update.callback_query
         tracking_number = query.data.split(":")[2]
         user_id = query.from_user.id
+        if self.workers.submit(user_id, self.answer_unsubscribe, query, tracking_number, user_id) is None:
+            query.answer("Please wait for your other requests to finish.")
+
+    def answer_unsubscribe(self, query, tracking_number, user_id):
         unsubscribed = self.unsubscribe(tracking_number, user_id, False)
         query.answer("Unsubscribed" if unsubscribed else "You're already unsubscribed!")
 
@@ -351,13 +384,47 @@ class PackageTrackerPlugin(Plugin):
         query = update.callback_query
         tracking_number = query.data.split(":")[2]
         user_id = query.from_user.id
+        if self.workers.submit(user_id, self.answer_subscribe, query, tracking_number, user_id) is None:
+            query.answer("Please wait for your other requests to finish.")
+
+    def answer_subscribe(self, query, tracking_number, user_id):
         subscribed = self.subscribe(tracking_number, user_id, False)
         query.answer("Subscribed" if subscribed else "You're already subscribed!")
 
+    def on_couriers_command(self, update, *args, **kwargs):
+        lines = []
+        for name, health in self.courier_health().items():
+            if health['state'] == 'closed':
+                lines.append("✅ {}".format(name))
+            elif health['state'] == 'open':
+                lines.append("❌ {} (unavailable, retrying in {}s)".format(name, int(health['retry_in'])))
+            else:
+                lines.append("⚠️ {} (recovering)".format(name))
+        update.message.reply_text("*Couriers:*\n\n{}".format("\n".join(lines)), parse_mode='Markdown')
+
+    def is_admin(self, user_id):
+        user = User.by_id(user_id)
+        return user is not None and user.role in ('admin', 'owner')
+
+    def on_sweepstats_command(self, update, *args, **kwargs):
+        if not self.is_admin(update.message.from_user.id):
+            update.message.reply_text("❌ You are not allowed to do that.")
+            return
+        profile = self.profiles.latest
+        if profile is None:
+            update.message.reply_text("No sweep has finished since the bot started.")
+            return
+        # Leave room for the code fences
+        text = format_profile(profile)[:MAX_MESSAGE_LENGTH - 8]
+        update.message.reply_text("```\n{}\n```".format(text), parse_mode='Markdown')
+
     def on_track_command(self, update, *args, **kwargs):
-        tracking_number = kwargs.get('id')
+        tracking_numbers = list(OrderedDict.fromkeys(kwargs.get('ids') or [kwargs.get('id')]))
+        if len(tracking_numbers) > 1 or kwargs.get('subscribe'):
+            return self.on_track_many(update, tracking_numbers, kwargs.get('subscribe'))
+
+        tracking_number = tracking_numbers[0]
         msg = update.message.reply_text("⌛ Parsing tracking number {}...".format(tracking_number))
-        handled = False
 
         # Build keyboard
         buttons = [
@@ -372,105 +439,359 @@ class PackageTrackerPlugin(Plugin):
             "parse_mode": "Markdown",
             "reply_markup": reply_markup
         }
-        if not any([courier['pattern'].match(tracking_number) for courier in self.couriers]):
+        # Look it up in the background; the placeholder is edited with the result
+        user_id = update.message.from_user.id
+        if self.workers.submit(user_id, self.track, tracking_number, user_id, message) is None:
+            message["text"] = "❌ You already have lookups in progress. Please wait for them to finish."
+            self.adapter.bot.editMessageText(**message)
+
+    def track(self, tracking_number, user_id, message):
+        courier = self.resolve_courier(tracking_number)
+        if courier is None:
             message["text"] = "❌ Given tracking number is not supported."
             self.adapter.bot.editMessageText(**message)
+            return
 
-        for courier in self.couriers:
-            m = courier['pattern'].match(tracking_number)
-            if not m:
-                continue
+        message["text"] = "⌛ Fetching updates from {} for {}...".format(courier['name'], tracking_number)
+        self.adapter.bot.editMessageText(**message)
 
-            message["text"] = "⌛ Fetching updates from {} for {}...".format(courier['name'], tracking_number)
+        result, status = courier['handler'](tracking_number)
+        if status == 200:
+            if len(result) == 0:
+                message["text"] = "❌ Invalid tracking number for *{}* or no updates available at this time.".format(courier['name'])
+                self.adapter.bot.editMessageText(**message)
+            else:
+                message["text"] = "🔔 *Updates for {}:*\n\n{}".format(tracking_number, format_events(result, self.config))
+                self.adapter.bot.editMessageText(**message)
+                if self.config.get('auto_subscribe'):
+                    self.subscribe(tracking_number, user_id, False)
+        else:
+            message["text"] = "❌ Service is unavailable for {} at this time. Please try later.".format(courier['name'])
             self.adapter.bot.editMessageText(**message)
 
-            result, status = courier['handler'](tracking_number)
-            if status == 200:
-                if len(result) == 0:
-                    message["text"] = "❌ Invalid tracking number for *{}* or no updates available at this time.".format(courier['name'])
-                    self.adapter.bot.editMessageText(**message)
-                else:
-                    message["text"] = "🔔 *Updates for {}:*\n\n{}".format(tracking_number, result)
-                    self.adapter.bot.editMessageText(**message)
-                    if self.config.get('auto_subscribe'):
-                        user_id = update.message.from_user.id
-                        self.subscribe(tracking_number, user_id, False)
+    def on_track_many(self, update, tracking_numbers, subscribe=False):
+        max_bulk_track = self.config.get('max_bulk_track')
+        if len(tracking_numbers) > max_bulk_track:
+            update.message.reply_text("❌ You can track up to {} tracking numbers at once.".format(max_bulk_track))
+            return
+
+        msg = update.message.reply_text("⌛ Fetching updates for {} tracking numbers...".format(len(tracking_numbers)))
+        message = {
+            "message_id": msg.message_id,
+            "chat_id": update.message.chat.id,
+            "parse_mode": "Markdown",
+        }
+        user_id = update.message.from_user.id
+        subscribe = subscribe or self.config.get('auto_subscribe')
+        if self.workers.submit(user_id, self.track_many, tracking_numbers, user_id, message, subscribe) is None:
+            message["text"] = "❌ You already have lookups in progress. Please wait for them to finish."
+            self.adapter.bot.editMessageText(**message)
+
+    def track_many(self, tracking_numbers, user_id, message, subscribe=False):
+        couriers = self.dispatcher.resolve_many(tracking_numbers)
+        jobs = [(tracking_number, courier, tracking_number) for tracking_number, courier in couriers.items() if courier is not None]
+        results = {}
+        for tracking_number, outcome in self.fetcher.fetch_all(jobs):
+            results[tracking_number] = outcome or [None, None]
+
+        lines = []
+        found = {}
+        for tracking_number in tracking_numbers:
+            courier = couriers[tracking_number]
+            if courier is None:
+                lines.append("❌ *{}*: not supported.".format(tracking_number))
+                continue
+            events, status = results[tracking_number]
+            if status != 200:
+                lines.append("❌ *{}*: {} is unavailable at this time.".format(tracking_number, courier['name']))
+            elif len(events) == 0:
+                lines.append("❌ *{}*: invalid tracking number for {} or no updates available.".format(tracking_number, courier['name']))
             else:
-                message["text"] = "❌ Service is unavailable for {} at this time. Please try later.".format(courier['name'])
-                self.adapter.bot.editMessageText(**message)
+                found[tracking_number] = courier['name']
+                # Just the latest event; the full history is one /track away
+                lines.append("🔔 *{}* ({}):\n{}".format(tracking_number, courier['name'], format_event(events[-1], self.config)))
+
+        if subscribe and found:
+            subscribed = TrackedPackage.subscribe_many(user_id, found)
+            lines.append("✅ Subscribed to updates for {} of {} tracking numbers.".format(len(subscribed), len(tracking_numbers)))
 
-            break
+        text = "\n\n".join(lines)
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text = text[:MAX_MESSAGE_LENGTH - 1] + "…"
+        message["text"] = text
+        self.adapter.bot.editMessageText(**message)
 
 
 def process_tracked_packages():
     plugin = process_tracked_packages.plugin
 
     def notify_subscribers(trackedPackage, message):
-        for subscriber in trackedPackage.subscribers:
-            plugin.adapter.bot.sendMessage(chat_id=subscriber,
-                                           text=message,
-                                           parse_mode='Markdown')
+        # The sweep doesn't load subscribers, read the current ones
+        subscribers = TrackedPackage.objects(id=trackedPackage.id).only('subscribers').first()
+        for subscriber in subscribers.subscribers if subscribers is not None else []:
+            # Queued; delivery is rate limited and never blocks the sweep
+            plugin.notifier.notify(chat_id=subscriber,
+                                   text=message,
+                                   parse_mode='Markdown')
+
+    writer = BulkWriter(TrackedPackage, plugin.config.get('sweep_batch_size'), metrics=plugin.metrics)
 
-    def process_tracked_package(trackedPackage):
+    def resolve_courier(trackedPackage):
         tracking_number = trackedPackage.tracking_number
-        # If no subscribers, skip
-        if len(trackedPackage.subscribers) == 0:
-            return
+        courier = plugin.resolve_courier(tracking_number)
         # Delete TrackedPackage and return if tracking number isn't valid
-        # What the... why didn't we store the courier in the 1st place?
-        # 'Cause reasons!
-        if not any([courier['pattern'].match(tracking_number) for courier in plugin.couriers]):
-            trackedPackage.date_deleted = localized_date()
-            trackedPackage.save()
-            log.error('Deleted TrackedPackage {} because tracking number {} did not match any couriers.'.format(trackedPackage._id, tracking_number))
+        if courier is None:
+            writer.update(trackedPackage.id, set={'date_deleted': localized_date()})
+            log.error('Deleted TrackedPackage {} because tracking number {} did not match any couriers.'.format(trackedPackage.id, tracking_number))
+        elif trackedPackage.courier != courier['name']:
+            trackedPackage.courier = courier['name']
+            writer.update(trackedPackage.id, set={'courier': courier['name']})
+        return courier
+
+    def process_tracked_package(trackedPackage, events, status, validators):
+        if events is SKIPPED:
+            # Courier is down; leave the package due for when it recovers
             return
-
-        for courier in plugin.couriers:
-            m = courier['pattern'].match(tracking_number)
-            if not m:
-                continue
-
-            # Call handler
-            result, status = courier['handler'](tracking_number)
-            # Update last time the page was fetched
-            trackedPackage.date_page_fetched = localized_date()
-            trackedPackage.save()
-            if status == 200:
-
-                if len(result) == 0:
-                    # Delete TrackedPackage if no results and notify subscribers
-                    trackedPackage.date_deleted = localized_date()
-                    trackedPackage.save()
-                    notify_subscribers(trackedPackage, "🚮 You have been unsubscribed from updates for {}.\nNo updates are available.".format(tracking_number))
-
-                elif result != trackedPackage.updates:
-                    # Notify subscribers of new results
-                    trackedPackage.updates = result
-                    trackedPackage.num_errors = 0
-                    trackedPackage.date_updated = localized_date()
-                    trackedPackage.save()
-                    notify_subscribers(trackedPackage, "🔔 *Updates for {}:*\n\n{}".format(tracking_number, result))
-                else:
-                    dtu = localized_date() - trackedPackage.date_updated if trackedPackage.date_updated is not None else None
-                    if dtu is not None and (dtu.total_seconds() / (24 * 60 * 60)) >= plugin.config.get('max_days_stalled'):
-                        trackedPackage.date_deleted = localized_date()
-                        trackedPackage.save()
-                        notify_subscribers(trackedPackage, "🚮 You have been unsubscribed from updates for {}.\nNo updates since {}.".format(tracking_number, trackedPackage.date_updated))
-                    # No change, verify dates
+        tracking_number = trackedPackage.tracking_number
+        now = localized_date()
+        # Update last time the page was fetched
+        changes = {'date_page_fetched': now}
+        increments = {}
+        pushes = {}
+        message = None
+        unstored, unnotified = [], []
+        if status == 200 and events is not UNCHANGED:
+            unstored, unnotified = new_events(trackedPackage, events, plugin.config)
+        if status == 200:
+            if validators or unstored:
+                # Keep the fingerprint in step with the stored events
+                changes['content_hash'] = validators.get('content_hash')
+                changes['etag'] = validators.get('etag')
+                changes['last_modified'] = validators.get('last_modified')
+
+            if events is not UNCHANGED and len(events) == 0:
+                # Delete TrackedPackage if no results and notify subscribers
+                changes['date_deleted'] = now
+                message = "🚮 You have been unsubscribed from updates for {}.\nNo updates are available.".format(tracking_number)
+
+            elif unstored:
+                # Store new events, only notify subscribers of those they haven't seen
+                pushes['events'] = unstored
+                changes['num_events'] = len(trackedPackage.events) + len(unstored)
+                changes['updates'] = None
+                if unnotified:
+                    changes['num_errors'] = 0
+                    changes['date_updated'] = now
+                    message = "🔔 *Updates for {}:*\n\n{}".format(tracking_number, format_events(unnotified, plugin.config))
+            else:
+                dtu = now - trackedPackage.date_updated if trackedPackage.date_updated is not None else None
+                if dtu is not None and (dtu.total_seconds() / (24 * 60 * 60)) >= plugin.config.get('max_days_stalled'):
+                    changes['date_deleted'] = now
+                    message = "🚮 You have been unsubscribed from updates for {}.\nNo updates since {}.".format(tracking_number, trackedPackage.date_updated)
+                # No change, verify dates
+        elif plugin.breakers.get(trackedPackage.courier).is_open:
+            # A courier outage says nothing about this tracking number
+            pass
+        else:
+            # Delete TrackedPackage if too many errors and notify subscribers
+            if trackedPackage.num_errors is not None and trackedPackage.num_errors > plugin.config.get('max_num_errors'):
+                changes['date_deleted'] = now
+                message = "🚮 You have been unsubscribed to receive updates for {}.".format(tracking_number)
+            elif trackedPackage.num_errors is None:
+                # $inc can't be applied to a null field
+                changes['num_errors'] = 1
             else:
-                # Delete TrackedPackage if too many errors and notify subscribers
-                if trackedPackage.num_errors is not None and trackedPackage.num_errors > plugin.config.get('max_num_errors'):
-                    trackedPackage.date_deleted = localized_date()
-                    trackedPackage.save()
-                    notify_subscribers(trackedPackage, "🚮 You have been unsubscribed to receive updates for {}.".format(tracking_number))
+                # Increase num errors
+                increments['num_errors'] = 1
+
+        # Mirror the changes locally to schedule the next check
+        for field, value in changes.items():
+            setattr(trackedPackage, field, value)
+        if increments:
+            trackedPackage.num_errors += increments['num_errors']
+        if trackedPackage.date_deleted is None:
+            changes['next_check_at'] = next_check_at(trackedPackage, plugin.config, sweep_started)
+
+        then = partial(notify_subscribers, trackedPackage, message) if message is not None else None
+        writer.update(trackedPackage.id, set=changes, inc=increments, push=pushes, then=then)
+
+    def check(trackedPackage, courier, tracking_number):
+        # No need to pace lookups that won't reach the courier
+        if pacer is not None and not plugin.breakers.get(courier['name']).is_open:
+            pacer.wait()
+        return plugin.check_courier(courier, trackedPackage)
+
+    def load_events(outcomes):
+        # Stored events are only needed where a page was actually parsed, not
+        # for failures or the UNCHANGED and SKIPPED sentinels
+        ids = [tp.id for tp, outcome in outcomes
+               if outcome is not None and isinstance(outcome[0], list) and outcome[0]]
+        if not ids:
+            return
+        with plugin.metrics.timer('db_read_seconds'):
+            stored = {tp.id: tp for tp in TrackedPackage.objects(id__in=ids).only('id', 'events', 'updates')}
+        for tp, outcome in outcomes:
+            if tp.id in stored:
+                tp.events = stored[tp.id].events
+                tp.updates = stored[tp.id].updates
+
+    now = sweep_started = localized_date()
+    started = time.perf_counter()
+    before = plugin.metrics.snapshot()
+    num_packages = 0
+    batch_size = plugin.config.get('sweep_batch_size')
+    names = [courier['name'] for courier in plugin.couriers]
+    lease_ttl = plugin.config.get('sweep_lease_ttl')
+
+    interval = timedelta(**plugin.config.get('process_interval')).total_seconds()
+    window = interval * (plugin.config.get('sweep_spread') or 0)
+    pacer = None
+
+    def sweep_shard(name, shard):
+        num_packages = 0
+        renewed_at = time.monotonic()
+
+        def keep_lease(force=False):
+            # Renew well before expiry, paced rounds can take a while
+            nonlocal renewed_at
+            if not force and time.monotonic() - renewed_at < lease_ttl / 4.0:
+                return True
+            renewed_at = time.monotonic()
+            return SweepLease.acquire(name, plugin.instance_id, lease_ttl)
+
+        # Resume an interrupted sweep of this shard where it left off
+        checkpoint = SweepCheckpoint.resume(name)
+        positions = dict(checkpoint.positions)
+        segments = OrderedDict((SweepCheckpoint.key(courier['name']), courier) for courier in plugin.couriers)
+        # Packages without a stored (or known) courier get resolved and updated
+        segments[UNRESOLVED] = None
+
+        # Every round takes one batch per courier so fetches stay spread across couriers
+        while segments:
+            jobs = []
+            for key, courier in list(segments.items()):
+                if courier is None:
+                    batch = TrackedPackage.sweep_batch(now, batch_size, positions.get(key), exclude_couriers=names, shard=shard)
                 else:
-                    # Increase num errors
-                    trackedPackage.num_errors = trackedPackage.num_errors + 1 if trackedPackage.num_errors is not None else 1
-                    trackedPackage.save()
-
-            break
-
-    tps = TrackedPackage.all()
-    for tp in tps:
-        process_tracked_package(tp)
-    adapter = process_tracked_packages.adapter
+                    batch = TrackedPackage.sweep_batch(now, batch_size, positions.get(key), courier=courier['name'], shard=shard)
+                with plugin.metrics.timer('db_read_seconds'):
+                    batch = list(batch)
+                num_packages += len(batch)
+                if len(batch) < batch_size:
+                    del segments[key]
+                if batch:
+                    positions[key] = batch[-1].id
+                for tp in batch:
+                    resolved = courier or resolve_courier(tp)
+                    if resolved is not None:
+                        jobs.append((tp, resolved, tp.tracking_number))
+
+            # Fetch concurrently, but keep processing results on this thread
+            outcomes = []
+            held = True
+            fetches = plugin.fetcher.fetch_all(jobs, fetch=check)
+            for outcome in fetches:
+                outcomes.append(outcome)
+                if not keep_lease():
+                    held = False
+                    break
+            fetches.close()
+            load_events(outcomes)
+            for tp, outcome in outcomes:
+                events, status, validators = outcome or [None, None, {}]
+                process_tracked_package(tp, events, status, validators)
+            writer.flush()
+
+            if not held or not keep_lease(force=True):
+                # Expired mid-round and taken over; its new holder resumes from the last checkpoint
+                log.warning('Lost the lease on {}, leaving it to its new holder.'.format(name))
+                return num_packages
+            checkpoint.positions = positions
+            checkpoint.date_modified = localized_date()
+            checkpoint.save()
+
+        checkpoint.delete()
+        return num_packages
+
+    # Work is split by id into shards, each swept by whichever instance leases it first
+    num_shards = max(1, plugin.config.get('sweep_shards'))
+    # Instances announce themselves, so each knows what share of the shards it will sweep
+    plugin.acquire_instance_lease(2 * interval)
+    num_instances = max(1, SweepLease.count_held(INSTANCE_LEASE_PREFIX))
+    # Every shard gets an equal slot of the window, instances sweeping theirs side by side
+    shard_window = window * min(num_instances, num_shards) / num_shards
+    # Instances start at different shards so they don't all contend for the same one
+    first = random.randrange(num_shards)
+    for i in range(num_shards):
+        index = (first + i) % num_shards
+        if num_shards == 1:
+            name, shard = 'process_tracked_packages', None
+        else:
+            name, shard = 'process_tracked_packages:{}/{}'.format(index, num_shards), (num_shards, index)
+        if not SweepLease.acquire(name, plugin.instance_id, lease_ttl):
+            plugin.metrics.inc('sweep_shards_total', result='held')
+            continue
+        # Spread the shard's fetches over its slot instead of bursting, so the
+        # combined request rate of all instances stays flat; never past the window
+        pacer = None
+        remaining = window - (time.perf_counter() - started)
+        if window > 0 and remaining > 0:
+            num_due = TrackedPackage.due(now, shard=shard).count()
+            if num_due:
+                # Never so slow that a shard lease could lapse between two lookups
+                rate = max(num_due / min(shard_window, remaining), 4.0 / lease_ttl)
+                pacer = Pacer(rate)
+                plugin.metrics.set('sweep_pace', rate)
+        try:
+            num_packages += sweep_shard(name, shard)
+            plugin.metrics.inc('sweep_shards_total', result='swept')
+        finally:
+            SweepLease.release(name, plugin.instance_id)
+
+    # Profile this sweep; interactive lookups made meanwhile are counted in too
+    elapsed = time.perf_counter() - started
+    plugin.metrics.inc('sweep_packages_total', num_packages)
+    plugin.metrics.set('sweep_duration_seconds', elapsed)
+    plugin.metrics.set('sweep_packages_per_second', num_packages / elapsed if elapsed else 0)
+    plugin.publish_profile({
+        'started': now,
+        'duration': elapsed,
+        'packages': num_packages,
+        'packages_per_second': num_packages / elapsed if elapsed else 0,
+        'metrics': since(plugin.metrics.snapshot(), before),
+    })
+
+
+SWEEP = SingleFlight(process_tracked_packages, 'Package sweep')
+"""Keeps sweeps from overlapping within this process."""
+
+
+def run_sweep():
+    """Scheduled entry point: runs process_tracked_packages unless a sweep is
+    already running in this process, in which case SWEEP's policy applies."""
+    if not SWEEP():
+        process_tracked_packages.plugin.metrics.inc('sweep_overlaps_total', policy=SWEEP.policy)
+
+
+def compact_tracked_packages():
+    """Archives packages deleted more than `retention_days` ago and purges
+    archive summaries older than `archive_retention_days`."""
+    plugin = compact_tracked_packages.plugin
+    # Once per database is enough, whichever instance gets there first
+    if not SweepLease.acquire('compact_tracked_packages', plugin.instance_id, plugin.config.get('sweep_lease_ttl')):
+        return
+    try:
+        now = localized_date()
+        archived = archive_deleted_packages(now - timedelta(days=plugin.config.get('retention_days')),
+                                            plugin.config.get('sweep_batch_size'))
+        plugin.metrics.inc('packages_archived_total', archived)
+        archive_retention_days = plugin.config.get('archive_retention_days')
+        if archive_retention_days is not None:
+            purged = purge_archived_packages(now - timedelta(days=archive_retention_days))
+            plugin.metrics.inc('archives_purged_total', purged)
+        # Instances that stopped without releasing their lease
+        SweepLease.purge_expired(INSTANCE_LEASE_PREFIX)
+    except Exception as err:
+        log.error('Unable to compact tracked packages: {}'.format(err))
+    finally:
+        SweepLease.release('compact_tracked_packages', plugin.instance_id)
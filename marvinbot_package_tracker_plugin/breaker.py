@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """Stops calls to a failing service.
+
+    Trips open after `failure_threshold` consecutive failures. After
+    `reset_timeout` seconds a single probe call is let through (half-open);
+    its success closes the breaker again, its failure re-opens it."""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=300):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.state != CLOSED
+
+    def allow(self):
+        """Returns whether a call may go through now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                if self.state != CLOSED:
+                    log.info('Circuit for {} closed.'.format(self.name))
+                self.state = CLOSED
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                    log.warning('Circuit for {} opened after {} consecutive failures.'.format(self.name, self.failures))
+                    self.state = OPEN
+                    self.opened_at = time.monotonic()
+            self._probing = False
+
+    def snapshot(self):
+        with self._lock:
+            retry_in = None
+            if self.state == OPEN:
+                retry_in = max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+            return {'state': self.state, 'failures': self.failures, 'retry_in': retry_in}
+
+
+class CircuitBreakers(object):
+    """One CircuitBreaker per courier name, created on first use."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=300):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name, self.failure_threshold, self.reset_timeout)
+            return breaker
+
+    def snapshot(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.snapshot() for breaker in breakers}
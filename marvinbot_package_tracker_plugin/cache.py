@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import threading
+import time
+
+
+class _InFlight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class LookupCache(object):
+    """In-process TTL cache with LRU eviction that coalesces lookups.
+
+    Concurrent `get_or_fetch` calls for the same key share a single call to
+    `fetch`. Only values accepted by `cacheable` are kept, for at most `ttl`
+    seconds; a `ttl` of 0 disables caching but still coalesces."""
+
+    def __init__(self, ttl=60, max_size=1024, cacheable=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.cacheable = cacheable or (lambda value: True)
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._get(key)
+        return entry[1] if entry is not None else None
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, value):
+        if self.ttl <= 0 or self.max_size <= 0 or not self.cacheable(value):
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_fetch(self, key, fetch):
+        with self._lock:
+            entry = self._get(key)
+            if entry is not None:
+                return entry[1]
+            in_flight = self._in_flight.get(key)
+            owner = in_flight is None
+            if owner:
+                in_flight = self._in_flight[key] = _InFlight()
+
+        if not owner:
+            in_flight.event.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.value
+
+        try:
+            in_flight.value = fetch()
+            self.put(key, in_flight.value)
+            return in_flight.value
+        except Exception as err:
+            in_flight.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.event.set()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
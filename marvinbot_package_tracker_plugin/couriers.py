@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from marvinbot_package_tracker_plugin.parsers import PARSERS
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+DEFAULT_COURIERS = [
+    {
+        'name': 'BMCargo',
+        'baseurl': 'http://erp-online.bmcargo.com/zz/estatus.aspx',
+        'pattern': r'^WR01-01\d{7}$',
+        'parser': 'grid',
+    },
+    {
+        'name': 'Aeropaq',
+        'baseurl': 'http://erp-online.aeropaq.com/zz/estatus.aspx',
+        'pattern': r'^WR02-\d{7}$',
+        'parser': 'grid',
+    },
+    {
+        'name': 'Caripack',
+        'baseurl': 'http://erp-online.caripack.com/zz/estatus.aspx',
+        'pattern': r'^G02-\d{10}$',
+        'parser': 'grid',
+    },
+    {
+        'name': 'Liberty Express',
+        'baseurl': 'http://online.libertyexpress.com/zz/estatus.aspx',
+        'pattern': r'^WR01-30\d{7}$',
+        'parser': 'grid',
+    },
+    {
+        'name': 'PickN\'Send',
+        'baseurl': 'http://online.picknsend.com/zz/estatus.aspx',
+        'pattern': r'^WR13-\d{9}$',
+        'parser': 'labels',
+    },
+    {
+        'name': 'DomEX',
+        'baseurl': 'https://domex-online.iplus.com.do/zz/estatus.aspx',
+        'pattern': r'^WR01-000\d{6}$',
+        'parser': 'grid',
+    },
+]
+
+LEGACY_PREFIXES = {
+    'bmcargo': 'BMCargo',
+    'aeropaq': 'Aeropaq',
+    'caripack': 'Caripack',
+    'liberty': 'Liberty Express',
+    'picknsend': 'PickN\'Send',
+    'domex': 'DomEX',
+}
+"""Config key prefixes used before the `couriers` list, by courier name."""
+
+
+def apply_legacy_config(config):
+    """Returns the `couriers` entries of `config` with any old-style
+    `<prefix>_baseurl` / `<prefix>_pattern` settings mapped onto them."""
+    entries = [dict(entry) for entry in config.get('couriers') or []]
+    by_name = {entry.get('name'): entry for entry in entries}
+    for prefix, name in LEGACY_PREFIXES.items():
+        for field in ('baseurl', 'pattern'):
+            key = '{}_{}'.format(prefix, field)
+            if config.get(key) is None:
+                continue
+            entry = by_name.get(name)
+            if entry is None:
+                log.warning('Ignoring deprecated setting {}: no "{}" entry in couriers.'.format(key, name))
+                continue
+            log.warning('Setting {} is deprecated, set "{}" on the "{}" entry of couriers instead.'.format(key, field, name))
+            entry[field] = config[key]
+    return entries
+
+
+def load_couriers(entries):
+    """Builds the courier registry from config entries.
+
+    Each entry needs a `name`, `baseurl` and `pattern`, and may name one of
+    the `PARSERS` (defaults to 'grid'). Invalid entries are logged and skipped."""
+    couriers = []
+    for entry in entries or []:
+        parser_name = entry.get('parser', 'grid')
+        if parser_name not in PARSERS:
+            log.error('Skipping courier {}: unknown parser "{}".'.format(entry.get('name'), parser_name))
+            continue
+        try:
+            couriers.append({
+                'name': entry['name'],
+                'baseurl': entry['baseurl'],
+                'pattern': re.compile(entry['pattern'], flags=re.IGNORECASE),
+                'parser': PARSERS[parser_name],
+            })
+        except (KeyError, re.error) as err:
+            log.error('Skipping invalid courier entry {}: {}'.format(entry, err))
+    return couriers
+
+
+class CourierDispatcher(object):
+    """Resolves a tracking number to its courier in a single regex pass.
+
+    Every courier pattern becomes a named alternative of one precompiled
+    regex, tried in registry order, so the first matching courier wins just
+    like a linear scan would."""
+
+    def __init__(self, couriers):
+        self.couriers = list(couriers)
+        self._by_group = {}
+        alternatives = []
+        for index, courier in enumerate(self.couriers):
+            group = 'c{}'.format(index)
+            self._by_group[group] = courier
+            alternatives.append('(?P<{}>{})'.format(group, courier['pattern'].pattern))
+        self._regex = None
+        try:
+            self._regex = re.compile('|'.join(alternatives), flags=re.IGNORECASE)
+        except re.error as err:
+            # e.g. patterns with clashing group names; fall back to scanning
+            log.error('Unable to combine courier patterns, falling back to linear dispatch: {}'.format(err))
+
+    def resolve(self, tracking_number):
+        """Returns the courier for `tracking_number`, or None if unsupported."""
+        if not tracking_number:
+            return None
+        if self._regex is None:
+            for courier in self.couriers:
+                if courier['pattern'].match(tracking_number):
+                    return courier
+            return None
+
+        m = self._regex.match(tracking_number)
+        if m is None:
+            return None
+        return self._by_group.get(m.lastgroup)
+
+    def resolve_many(self, tracking_numbers):
+        """Returns a {tracking_number: courier or None} dict."""
+        return {tracking_number: self.resolve(tracking_number) for tracking_number in tracking_numbers}
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class CourierFetcher(object):
+    """Runs courier lookups on a bounded thread pool.
+
+    At most `max_workers` lookups are in flight at once per `fetch_all`.
+    Requests to a courier go through `slot`, which holds them to
+    `max_per_courier` at a time across every caller sharing this fetcher.
+    """
+
+    def __init__(self, max_workers=8, max_per_courier=2):
+        self.max_workers = max(1, max_workers)
+        self.max_per_courier = max(1, max_per_courier)
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def slot(self, name):
+        """Returns the semaphore bounding concurrent requests to courier `name`."""
+        with self._lock:
+            slot = self._slots.get(name)
+            if slot is None:
+                slot = self._slots[name] = threading.BoundedSemaphore(self.max_per_courier)
+            return slot
+
+    @staticmethod
+    def fetch(key, courier, tracking_number):
+        return courier['handler'](tracking_number)
+
+    @staticmethod
+    def _call(fetch, key, courier, tracking_number):
+        try:
+            return fetch(key, courier, tracking_number)
+        except Exception as err:
+            log.error("Unable to fetch {} from {}: {}".format(tracking_number, courier['name'], err))
+            return None
+
+    def fetch_all(self, jobs, fetch=None):
+        """Fetches every (key, courier, tracking_number) job in `jobs`.
+
+        `fetch(key, courier, tracking_number)` defaults to calling the
+        courier's handler. Yields (key, outcome) tuples in completion order,
+        where outcome is None if the fetch raised. Jobs are only handed to the
+        pool when their courier has a free slot, so a backlog for one courier
+        never starves the others of workers."""
+        fetch = fetch or self.fetch
+        pending = OrderedDict()
+        for job in jobs:
+            pending.setdefault(job[1]['name'], deque()).append(job)
+
+        in_flight = {}
+        per_courier = Counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or in_flight:
+                for name in list(pending):
+                    queue = pending[name]
+                    while queue and per_courier[name] < self.max_per_courier and len(in_flight) < self.max_workers:
+                        key, courier, tracking_number = queue.popleft()
+                        future = executor.submit(self._call, fetch, key, courier, tracking_number)
+                        in_flight[future] = (key, name)
+                        per_courier[name] += 1
+                    if not queue:
+                        del pending[name]
+
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, name = in_flight.pop(future)
+                    per_courier[name] -= 1
+                    yield key, future.result()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import bisect
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server only has its own from Python 3.7
+    daemon_threads = True
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+"""Histogram bucket upper bounds, in seconds."""
+
+
+class Histogram(object):
+    """Counts observations into fixed buckets. Not thread safe; Metrics holds the lock."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        return histogram
+
+    def minus(self, other):
+        histogram = self.copy()
+        if other is not None:
+            histogram.counts = [a - b for a, b in zip(self.counts, other.counts)]
+            histogram.sum -= other.sum
+        return histogram
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the `q` quantile, or None when empty."""
+        rank = q * self.count
+        if not rank:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+
+class Metrics(object):
+    """Thread safe counters, gauges and latency histograms, each keyed by a
+    name and its labels."""
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self.key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes how long the block takes, in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """Returns a copy of every metric as a {'counters', 'gauges',
+        'histograms'} dict of {(name, labels): value} dicts."""
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'histograms': {key: histogram.copy() for key, histogram in self._histograms.items()},
+            }
+
+
+def since(current, previous):
+    """What was recorded between two snapshots. Gauges are taken from `current`."""
+    return {
+        'counters': {key: value - previous['counters'].get(key, 0)
+                     for key, value in current['counters'].items()
+                     if value != previous['counters'].get(key, 0)},
+        'gauges': dict(current['gauges']),
+        'histograms': {key: histogram.minus(previous['histograms'].get(key))
+                       for key, histogram in current['histograms'].items()
+                       if histogram.count != getattr(previous['histograms'].get(key), 'count', 0)},
+    }
+
+
+def format_key(key):
+    name, labels = key
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(label, value) for label, value in labels))
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return '>{}s'.format(LATENCY_BUCKETS[-1])
+    return '{:.0f}ms'.format(seconds * 1000) if seconds < 1 else '{:.1f}s'.format(seconds)
+
+
+def format_profile(profile):
+    """Renders a sweep profile as plain text, one metric per line."""
+    lines = ['Sweep started {}: {} packages in {:.1f}s ({:.1f} packages/s)'.format(
+        profile['started'].strftime('%Y-%m-%d %H:%M:%S'), profile['packages'],
+        profile['duration'], profile['packages_per_second'])]
+    metrics = profile['metrics']
+    for key, histogram in sorted(metrics['histograms'].items()):
+        lines.append('{} n={} mean={} p50<={} p95<={}'.format(
+            format_key(key), histogram.count, format_seconds(histogram.sum / histogram.count),
+            format_seconds(histogram.quantile(0.5)), format_seconds(histogram.quantile(0.95))))
+    for key, value in sorted(metrics['counters'].items()):
+        lines.append('{} {}'.format(format_key(key), value))
+    return '\n'.join(lines)
+
+
+def render_prometheus(snapshot, prefix='package_tracker_'):
+    """Renders a snapshot in the Prometheus text exposition format."""
+    lines = []
+    typed = set()
+
+    def sample(name, labels, value):
+        lines.append('{} {}'.format(format_key((prefix + name, labels)), value))
+
+    for kind, metrics in (('counter', snapshot['counters']), ('gauge', snapshot['gauges'])):
+        for (name, labels), value in sorted(metrics.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {}{} {}'.format(prefix, name, kind))
+            sample(name, labels, value)
+    for (name, labels), histogram in sorted(snapshot['histograms'].items()):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {}{} histogram'.format(prefix, name))
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            sample(name + '_bucket', labels + (('le', bound),), cumulative)
+        sample(name + '_sum', labels, histogram.sum)
+        sample(name + '_count', labels, cumulative)
+    return '\n'.join(lines) + '\n'
+
+
+class MemorySink(object):
+    """Keeps the `size` most recent sweep profiles."""
+
+    def __init__(self, size=10):
+        self.profiles = deque(maxlen=size)
+
+    @property
+    def latest(self):
+        return self.profiles[-1] if self.profiles else None
+
+    def publish(self, profile):
+        self.profiles.append(profile)
+
+    def close(self):
+        pass
+
+
+class LogSink(object):
+    """Logs a summary of every sweep profile."""
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def publish(self, profile):
+        log.log(self.level, format_profile(profile))
+
+    def close(self):
+        pass
+
+
+class PrometheusSink(object):
+    """Serves `metrics` in the Prometheus text format at http://host:port/metrics.
+
+    Sweep profiles are already part of the registry, so publishing is a no-op."""
+
+    def __init__(self, metrics, host='127.0.0.1', port=9105):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render_prometheus(metrics.snapshot()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='package_tracker_metrics', daemon=True)
+        self._thread.start()
+        log.info('Serving metrics on http://{}:{}/metrics'.format(host, port))
+
+    def publish(self, profile):
+        pass
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
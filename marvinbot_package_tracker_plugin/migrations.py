@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from marvinbot_package_tracker_plugin.models import TrackedPackage
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def backfill_couriers(dispatcher):
+    """Stores the resolved courier on live packages created before the
+    `courier` field existed. Safe to run repeatedly; returns the number of
+    packages updated."""
+    count = 0
+    for tp in TrackedPackage.objects(courier=None, date_deleted=None).only('id', 'tracking_number'):
+        courier = dispatcher.resolve(tp.tracking_number)
+        if courier is None:
+            # Left for the sweep, which deletes unsupported tracking numbers
+            continue
+        count += TrackedPackage.objects(id=tp.id, courier=None).update_one(set__courier=courier['name'])
+    if count:
+        log.info('Backfilled courier on {} tracked packages.'.format(count))
+    return count
@@ -1,16 +1,42 @@
 import mongoengine
 from marvinbot.utils import localized_date
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from datetime import timedelta
+
+
+SWEEP_FIELDS = ('id', 'tracking_number', 'courier', 'date_updated', 'date_added',
+                'num_errors', 'content_hash', 'etag', 'last_modified')
+"""TrackedPackage fields loaded by the sweep."""
+
+
+class TrackingEvent(mongoengine.EmbeddedDocument):
+    status = mongoengine.StringField()
+    date = mongoengine.StringField()
+    time = mongoengine.StringField()
+    location = mongoengine.StringField(null=True)
+
+    def to_event(self):
+        return {'status': self.status, 'date': self.date, 'time': self.time, 'location': self.location}
 
 
 class TrackedPackage(mongoengine.Document):
     id = mongoengine.SequenceField(primary_key=True)
     tracking_number = mongoengine.StringField(unique=True)
 
+    courier = mongoengine.StringField(null=True)
+    """Name of the courier this tracking number was resolved to."""
+
     subscribers = mongoengine.ListField(mongoengine.LongField())
     """Subscribers of this package."""
 
     updates = mongoengine.StringField(null=True)
-    """Most recent updates from package."""
+    """Most recent updates from package, formatted. Superseded by `events`."""
+
+    events = mongoengine.ListField(mongoengine.EmbeddedDocumentField(TrackingEvent))
+    """Every scan event seen for this package, in the order they were first seen."""
+
+    num_events = mongoengine.IntField(default=0)
+    """Number of events in `events`, so they needn't be loaded to count them."""
 
     date_page_fetched = mongoengine.DateTimeField(null=True)
     """Stores the last time this TrackedPackage was fetched for changes successfully."""
@@ -18,12 +44,30 @@ class TrackedPackage(mongoengine.Document):
     date_updated = mongoengine.DateTimeField(null=True)
     """Stores the last time the package was updated."""
 
+    content_hash = mongoengine.StringField(null=True)
+    """Fingerprint of the status page `updates` was parsed from."""
+
+    etag = mongoengine.StringField(null=True)
+    last_modified = mongoengine.StringField(null=True)
+    """Validators sent by the courier with that page, if any."""
+
     num_errors = mongoengine.LongField(null=True)
 
+    next_check_at = mongoengine.DateTimeField(null=True)
+    """When this package is next due to be fetched. None means as soon as possible."""
+
     date_added = mongoengine.DateTimeField(default=localized_date)
     date_modified = mongoengine.DateTimeField(default=localized_date)
     date_deleted = mongoengine.DateTimeField(required=False, null=True)
 
+    meta = {
+        'indexes': [
+            ('courier', 'date_deleted', 'next_check_at'),
+            ('courier', 'date_deleted', 'id'),
+            'date_deleted',
+        ]
+    }
+
     @classmethod
     def by_tracking_number(cls, tracking_number):
         try:
@@ -38,5 +82,204 @@ class TrackedPackage(mongoengine.Document):
         except:
             return None
 
+    @classmethod
+    def add_subscriber(cls, tracking_number, user_id, courier=None):
+        """Adds `user_id` to the subscribers of `tracking_number` with a single
+        $addToSet, creating the package if it doesn't exist yet.
+
+        Returns True if subscribed, False if already subscribed and None if
+        the package was deleted, archived packages included."""
+        result = cls.objects(tracking_number=tracking_number, date_deleted=None).update_one(
+            add_to_set__subscribers=user_id, full_result=True)
+        if result.matched_count:
+            return result.modified_count > 0
+        if ArchivedPackage.objects(id=tracking_number).only('id').first() is not None:
+            return None
+        try:
+            # Inserted rather than upserted so it gets a sequence id
+            cls(tracking_number=tracking_number, courier=courier, subscribers=[user_id]).save(force_insert=True)
+            return True
+        except mongoengine.NotUniqueError:
+            # Deleted, or created concurrently
+            result = cls.objects(tracking_number=tracking_number, date_deleted=None).update_one(
+                add_to_set__subscribers=user_id, full_result=True)
+            return result.modified_count > 0 if result.matched_count else None
+
+    @classmethod
+    def remove_subscriber(cls, tracking_number, user_id):
+        """Removes `user_id` from the subscribers of `tracking_number` with a
+        single $pull.
+
+        Returns True if unsubscribed, False if not subscribed and None if
+        the package doesn't exist or was deleted."""
+        result = cls.objects(tracking_number=tracking_number, date_deleted=None).update_one(
+            pull__subscribers=user_id, full_result=True)
+        return result.modified_count > 0 if result.matched_count else None
+
+    @classmethod
+    def subscribe_many(cls, user_id, couriers):
+        """Subscribes `user_id` to every tracking number in `couriers`, a
+        {tracking_number: courier name} dict, creating the packages that
+        don't exist yet. Deleted and archived packages are left alone.
+
+        Costs one lookup, one archive lookup, one insert and one $addToSet
+        update however many tracking numbers are given. Returns the tracking
+        numbers subscribed to."""
+        tracking_numbers = list(couriers)
+        existing = {tp.tracking_number: tp.date_deleted
+                    for tp in cls.objects(tracking_number__in=tracking_numbers).only('tracking_number', 'date_deleted')}
+        missing = [tracking_number for tracking_number in tracking_numbers if tracking_number not in existing]
+        if missing:
+            existing.update((archived.id, archived.date_deleted)
+                            for archived in ArchivedPackage.objects(id__in=missing).only('id', 'date_deleted'))
+            missing = [tracking_number for tracking_number in missing if tracking_number not in existing]
+        if missing:
+            documents = [cls(tracking_number=tracking_number, courier=couriers[tracking_number], subscribers=[user_id]).to_mongo()
+                         for tracking_number in missing]
+            try:
+                cls._get_collection().insert_many(documents, ordered=False)
+            except BulkWriteError:
+                # Created concurrently; the update below subscribes to those too
+                pass
+        live = [tracking_number for tracking_number in tracking_numbers if existing.get(tracking_number) is None]
+        cls.objects(tracking_number__in=live, date_deleted=None).update(add_to_set__subscribers=user_id)
+        return live
+
+    @classmethod
+    def due(cls, due_before, shard=None):
+        """Live packages with subscribers that are due to be checked by
+        `due_before`, in `shard` (see `sweep_batch`) if given."""
+        query = cls.objects(date_deleted=None, __raw__={'subscribers.0': {'$exists': True}})
+        if shard is not None:
+            query = query.filter(id__mod=shard)
+        return query.filter(mongoengine.Q(next_check_at=None) | mongoengine.Q(next_check_at__lte=due_before))
+
+    @classmethod
+    def sweep_batch(cls, due_before, limit, after_id=None, courier=None, exclude_couriers=None, shard=None):
+        """Up to `limit` live packages with subscribers that are due by
+        `due_before`, in id order after `after_id`. Packages belong to
+        `courier`, or to none of `exclude_couriers` when that is given, and
+        to `shard`, a (num_shards, index) pair matching id % num_shards == index.
+
+        Only the fields the sweep needs are loaded; `events`, `updates` and
+        `subscribers` are left out."""
+        query = cls.due(due_before, shard)
+        if exclude_couriers is not None:
+            query = query.filter(courier__nin=exclude_couriers)
+        else:
+            query = query.filter(courier=courier)
+        if after_id is not None:
+            query = query.filter(id__gt=after_id)
+        return query.only(*SWEEP_FIELDS).order_by('id').limit(limit)
+
     def __str__(self):
-        return "{{ id = {id}, tracking_number = \"{tracking_number}\", updates = {updates}, subscribers = \"{subscribers}\", date_page_fetched = {date_page_fetched}, date_updated = {date_updated} }}".format(id=self.id, tracking_number=self.tracking_number, updates=self.updates, subscribers=", ".join(self.subscribers), date_page_fetched=self.date_page_fetched, date_updated=self.date_updated)
+        return "{{ id = {id}, tracking_number = \"{tracking_number}\", courier = {courier}, updates = {updates}, subscribers = \"{subscribers}\", date_page_fetched = {date_page_fetched}, date_updated = {date_updated} }}".format(id=self.id, tracking_number=self.tracking_number, courier=self.courier, updates=self.updates, subscribers=", ".join(self.subscribers), date_page_fetched=self.date_page_fetched, date_updated=self.date_updated)
+
+
+class ArchivedPackage(mongoengine.Document):
+    """What is kept of a deleted TrackedPackage once its retention period is over."""
+
+    id = mongoengine.StringField(primary_key=True)
+    """Tracking number."""
+
+    courier = mongoengine.StringField(null=True)
+    num_subscribers = mongoengine.IntField(default=0)
+    num_events = mongoengine.IntField(default=0)
+
+    last_event = mongoengine.EmbeddedDocumentField(TrackingEvent, null=True)
+    """Latest scan event of the package."""
+
+    last_update = mongoengine.StringField(null=True)
+    """Last line of the legacy `updates` text, for packages without stored events."""
+
+    date_added = mongoengine.DateTimeField(null=True)
+    date_updated = mongoengine.DateTimeField(null=True)
+    date_deleted = mongoengine.DateTimeField(null=True)
+    date_archived = mongoengine.DateTimeField(default=localized_date)
+
+    meta = {
+        'indexes': [
+            'date_archived',
+        ]
+    }
+
+    @classmethod
+    def from_package(cls, trackedPackage):
+        """Summarizes `trackedPackage`, loaded with at least its last event."""
+        updates = (trackedPackage.updates or '').strip()
+        return cls(id=trackedPackage.tracking_number,
+                   courier=trackedPackage.courier,
+                   num_subscribers=len(trackedPackage.subscribers),
+                   num_events=trackedPackage.num_events or len(trackedPackage.events),
+                   last_event=trackedPackage.events[-1] if trackedPackage.events else None,
+                   last_update=updates.splitlines()[-1] if updates and not trackedPackage.events else None,
+                   date_added=trackedPackage.date_added,
+                   date_updated=trackedPackage.date_updated,
+                   date_deleted=trackedPackage.date_deleted)
+
+
+class SweepCheckpoint(mongoengine.Document):
+    id = mongoengine.StringField(primary_key=True)
+    """Name of the sweep."""
+
+    positions = mongoengine.DictField()
+    """Last processed TrackedPackage id, per courier."""
+
+    date_added = mongoengine.DateTimeField(default=localized_date)
+    date_modified = mongoengine.DateTimeField(default=localized_date)
+
+    @classmethod
+    def resume(cls, name):
+        """Returns the checkpoint of an interrupted `name` sweep, or a new one."""
+        checkpoint = cls.objects(id=name).first()
+        if checkpoint is None:
+            checkpoint = cls(id=name)
+        return checkpoint
+
+    @staticmethod
+    def key(courier):
+        # Mongo field names can't contain dots or start with $
+        return courier.replace('.', '_').replace('$', '_')
+
+
+class SweepLease(mongoengine.Document):
+    id = mongoengine.StringField(primary_key=True)
+    """Name of the leased sweep shard."""
+
+    owner = mongoengine.StringField()
+    """Plugin instance holding the lease."""
+
+    expires_at = mongoengine.DateTimeField()
+    """When other instances may take the lease over."""
+
+    date_modified = mongoengine.DateTimeField(default=localized_date)
+
+    @classmethod
+    def acquire(cls, name, owner, ttl):
+        """Takes or renews the lease on `name` for `ttl` seconds in a single
+        upsert. Returns whether `owner` holds it."""
+        now = localized_date()
+        try:
+            cls._get_collection().update_one(
+                {'_id': name, '$or': [{'owner': owner}, {'expires_at': {'$lte': now}}]},
+                {'$set': {'owner': owner, 'expires_at': now + timedelta(seconds=ttl), 'date_modified': now}},
+                upsert=True)
+        except DuplicateKeyError:
+            # Held by another instance and not expired
+            return False
+        return True
+
+    @classmethod
+    def count_held(cls, prefix):
+        """Number of unexpired leases whose name starts with `prefix`."""
+        return cls.objects(id__startswith=prefix, expires_at__gt=localized_date()).count()
+
+    @classmethod
+    def release(cls, name, owner):
+        cls._get_collection().delete_one({'_id': name, 'owner': owner})
+
+    @classmethod
+    def purge_expired(cls, prefix):
+        """Deletes the expired leases whose name starts with `prefix`.
+        Returns the number deleted."""
+        return cls.objects(id__startswith=prefix, expires_at__lte=localized_date()).delete()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict, deque
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Allows `rate` operations per second on average, in bursts of up to
+    `capacity`. Not thread safe; callers hold their own lock."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Takes a token and returns 0, or returns how many seconds to wait for one."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Notifier(object):
+    """Delivers messages from a queue on a background thread.
+
+    Sends are limited to `rate` messages per second overall and one message
+    per `chat_interval` seconds per chat, with chats served round-robin. A
+    send failing with a `retry_after` (Telegram's 429) pauses delivery for
+    that long and is retried up to `max_attempts` times. Identical messages
+    still waiting for the same chat are only queued once. Send latency and
+    outcomes are recorded to `metrics`, if given."""
+
+    def __init__(self, send, rate=30, chat_interval=1.0, max_attempts=5, metrics=None):
+        self.send = send
+        self.metrics = metrics
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self._bucket = TokenBucket(rate)
+        self._queues = OrderedDict()
+        self._pending = set()
+        self._next_send = {}
+        self._paused_until = 0
+        self._cond = threading.Condition()
+        self._running = False
+        self._busy = False
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='package_tracker_notifier', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self.pending:
+            log.warning('Notifier stopped with {} undelivered messages.'.format(self.pending))
+
+    def drain(self, timeout=None):
+        """Waits until every queued message has been handled. Returns False on timeout."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while self._queues or self._busy:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    @property
+    def pending(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def notify(self, chat_id, text, **kwargs):
+        """Queues `text` for `chat_id`. Returns False if it was already pending."""
+        key = (chat_id, text)
+        with self._cond:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+            self._queues.setdefault(chat_id, deque()).append((text, kwargs, 0))
+            self._cond.notify()
+        self.start()
+        return True
+
+    def _next(self):
+        # Returns (item, 0) or (None, seconds to wait). Called with the lock held.
+        now = time.monotonic()
+        if self._paused_until > now:
+            return None, self._paused_until - now
+
+        wait = None
+        for chat_id in list(self._queues):
+            ready_at = self._next_send.get(chat_id, 0)
+            if ready_at > now:
+                wait = min(wait, ready_at - now) if wait is not None else ready_at - now
+                continue
+            delay = self._bucket.take()
+            if delay:
+                return None, delay
+            queue = self._queues.pop(chat_id)
+            text, kwargs, attempts = queue.popleft()
+            if queue:
+                # Back of the line, so other chats get their turn
+                self._queues[chat_id] = queue
+            self._pending.discard((chat_id, text))
+            self._next_send[chat_id] = now + self.chat_interval
+            return (chat_id, text, kwargs, attempts), 0
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queues:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                item, wait = self._next()
+                if item is None:
+                    self._cond.wait(wait)
+                    continue
+                # Forget chats that have gone quiet
+                if len(self._next_send) > 10000:
+                    now = time.monotonic()
+                    self._next_send = {chat_id: ready_at for chat_id, ready_at in self._next_send.items() if ready_at > now}
+                self._busy = True
+            try:
+                self._deliver(*item)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _record(self, started, result):
+        if self.metrics is not None:
+            self.metrics.observe('notify_send_seconds', time.perf_counter() - started)
+            self.metrics.inc('notify_sends_total', result=result)
+
+    def _deliver(self, chat_id, text, kwargs, attempts):
+        started = time.perf_counter()
+        try:
+            self.send(chat_id=chat_id, text=text, **kwargs)
+            self._record(started, 'sent')
+        except Exception as err:
+            retry_after = getattr(err, 'retry_after', None)
+            if retry_after is None or attempts + 1 >= self.max_attempts:
+                self._record(started, 'failed')
+                log.error('Unable to send message to {}: {}'.format(chat_id, err))
+                return
+            self._record(started, 'retried')
+            log.warning('Rate limited sending to {}, retrying in {}s.'.format(chat_id, retry_after))
+            with self._cond:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                if (chat_id, text) not in self._pending:
+                    self._pending.add((chat_id, text))
+                    self._queues.setdefault(chat_id, deque()).appendleft((text, kwargs, attempts + 1))
+                    self._queues.move_to_end(chat_id, last=False)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from bs4 import BeautifulSoup, SoupStrainer
+import logging
+
+try:
+    import lxml  # noqa: F401
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+log = logging.getLogger(__name__)
+
+# Only the grid cells (and their contents) are ever looked at, so don't
+# build a tree for the rest of the page
+GRID_CELLS = SoupStrainer('td', attrs={'class': 'dxgv'})
+
+
+def html_backend(config):
+    """Resolves the `html_parser` setting to an installed BeautifulSoup backend."""
+    backend = config.get('html_parser') or 'auto'
+    if backend == 'auto':
+        return 'lxml' if HAS_LXML else 'html.parser'
+    if backend == 'lxml' and not HAS_LXML:
+        log.warning('lxml is not installed, falling back to html.parser')
+        return 'html.parser'
+    return backend
+
+
+def make_soup(text, config):
+    return BeautifulSoup(text, html_backend(config), parse_only=GRID_CELLS)
+
+
+def is_grid_cell(tag):
+    # Same as the td[class=dxgv] selector, without the CSS selector overhead
+    return tag.name == 'td' and tag.get('class') == ['dxgv']
+
+
+def make_event(status, date, time, location=None):
+    return {'status': str(status), 'date': date, 'time': time, 'location': location}
+
+
+def event_key(event):
+    return (event['status'], event['date'], event['time'], event.get('location'))
+
+
+def format_event(event, config):
+    if event.get('location') is None:
+        return config.get('response_format_noloc').format(status=event['status'], date=event['date'], time=event['time'])
+    return config.get('response_format').format(status=event['status'], date=event['date'], time=event['time'], loc=event['location'])
+
+
+def format_events(events, config):
+    return "\n".join(format_event(event, config) for event in events)
+
+
+def parse_grid(text, config):
+    """Parses the DevExpress grid used by most erp-online estatus pages into
+    a list of events."""
+    soup = make_soup(text, config)
+    events = []
+    try:
+        for td in soup.find_all(is_grid_cell):
+            first_div, second_div = td.find_all('div')
+            status = first_div.find('span').contents[0]
+            contents = second_div.contents
+            date = contents[0].strip().replace('.', '-')
+            time = contents[2].strip().upper()
+
+            if len(contents) >= 4:
+                events.append(make_event(status, date, time, contents[4].strip()))
+            else:
+                events.append(make_event(status, date, time))
+    except Exception as err:
+        log.error("Parse error: {}".format(err))
+
+    return events
+
+
+def parse_labels(text, config):
+    """Parses the label based grid used by PickN'Send into a list of events."""
+    soup = make_soup(text, config)
+    events = []
+    try:
+        labels = [label for td in soup.find_all(is_grid_cell) for label in td.find_all('label')]
+        label_pairs = [labels[i:i + 2] for i in range(0, len(labels), 2)]
+        for first_label, second_label in label_pairs:
+            status = first_label.contents[0]
+            st, loc, datetime = [x.strip() for x in second_label.contents[0].split(',')]
+            date, time = [x.strip() for x in datetime.split('|')]
+            events.append(make_event(status, date.replace('.', '-'), time.upper(), loc.upper()))
+    except Exception as err:
+        log.error("Parse error: {}".format(err))
+
+    return events
+
+
+PARSERS = {
+    'grid': parse_grid,
+    'labels': parse_labels,
+}
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from pymongo import UpdateOne
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class BulkWriter(object):
+    """Collects field level updates to documents of `document_cls` and writes
+    them with a single unordered `bulk_write` per `batch_size` documents.
+
+    Updates to the same document are merged. Callables passed as `then` run
+    once the batch holding their update has been written successfully.
+    Write latency is recorded to `metrics`, if given."""
+
+    def __init__(self, document_cls, batch_size=100, metrics=None):
+        self.document_cls = document_cls
+        self.batch_size = max(1, batch_size)
+        self.metrics = metrics
+        self._updates = OrderedDict()
+        self._callbacks = []
+
+    def _db_field(self, name):
+        return self.document_cls._fields[name].db_field
+
+    def update(self, doc_id, set=None, inc=None, push=None, then=None):
+        """Adds $set, $inc and $push (of a list of items) field updates for `doc_id`."""
+        update = self._updates.setdefault(doc_id, {})
+        for operator, fields in (('$set', set), ('$inc', inc)):
+            for name, value in (fields or {}).items():
+                update.setdefault(operator, {})[self._db_field(name)] = value
+        for name, items in (push or {}).items():
+            pushed = update.setdefault('$push', {}).setdefault(self._db_field(name), {'$each': []})
+            pushed['$each'].extend(items)
+        if then is not None:
+            self._callbacks.append(then)
+        if len(self._updates) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        updates, self._updates = self._updates, OrderedDict()
+        callbacks, self._callbacks = self._callbacks, []
+        operations = [UpdateOne({'_id': doc_id}, update) for doc_id, update in updates.items() if update]
+        if operations:
+            started = time.perf_counter()
+            try:
+                self.document_cls._get_collection().bulk_write(operations, ordered=False)
+            except Exception as err:
+                if self.metrics is not None:
+                    self.metrics.inc('db_write_errors_total')
+                # Skip the callbacks too; the next sweep will see the same changes again
+                log.error('Unable to write {} {} updates: {}'.format(len(operations), self.document_cls.__name__, err))
+                return 0
+            if self.metrics is not None:
+                self.metrics.observe('db_write_seconds', time.perf_counter() - started)
+        for callback in callbacks:
+            callback()
+        return len(operations)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+import random
+
+
+def next_check_at(trackedPackage, config, now):
+    """Returns when `trackedPackage` should be fetched again, counting from
+    `now`, the start of the sweep that processed it. A sweep picks up the
+    packages due by its own start, so counting from when the package was
+    processed would make every delay miss a sweep.
+
+    Packages that changed recently are checked every `min_check_interval`;
+    the delay then grows with the time since the last update (scaled by
+    `check_backoff_factor`) and doubles for every consecutive error, but
+    never exceeds `max_check_interval`. The delay is then randomly shortened
+    by up to `check_jitter` (a fraction), so packages added or updated
+    together don't all fall due at once. Never lengthened, which could push a
+    package past the sweep it is due for."""
+    min_interval = timedelta(**config.get('min_check_interval'))
+    max_interval = timedelta(**config.get('max_check_interval'))
+
+    last_change = trackedPackage.date_updated or trackedPackage.date_added or now
+    delay = (now - last_change) * config.get('check_backoff_factor')
+    if trackedPackage.num_errors:
+        delay = max(delay, min_interval) * 2 ** min(trackedPackage.num_errors, 10)
+
+    delay = min(max(delay, min_interval), max_interval)
+    jitter = config.get('check_jitter') or 0
+    return now + delay * random.uniform(1 - jitter, 1)
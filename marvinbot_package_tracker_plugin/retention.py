@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from marvinbot_package_tracker_plugin.models import ArchivedPackage, TrackedPackage
+from pymongo import ReplaceOne
+import logging
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_FIELDS = ('id', 'tracking_number', 'courier', 'subscribers', 'updates', 'num_events',
+                  'date_added', 'date_updated', 'date_deleted')
+"""TrackedPackage fields loaded to archive a package, besides its last event."""
+
+
+def archive_deleted_packages(deleted_before, batch_size=100):
+    """Replaces packages deleted before `deleted_before` with an
+    ArchivedPackage summary each. Safe to run repeatedly; returns the number
+    of packages archived."""
+    count = 0
+    while True:
+        batch = list(TrackedPackage.objects(date_deleted__lte=deleted_before)
+                     .only(*ARCHIVE_FIELDS).fields(slice__events=-1)
+                     .order_by('id').limit(batch_size))
+        if not batch:
+            break
+        # Summaries go in first, so an interrupted run can only leave duplicates behind
+        summaries = [ArchivedPackage.from_package(tp).to_mongo() for tp in batch]
+        ArchivedPackage._get_collection().bulk_write(
+            [ReplaceOne({'_id': summary['_id']}, summary, upsert=True) for summary in summaries], ordered=False)
+        count += TrackedPackage.objects(id__in=[tp.id for tp in batch], date_deleted__ne=None).delete()
+        if len(batch) < batch_size:
+            break
+    if count:
+        log.info('Archived {} deleted tracked packages.'.format(count))
+    return count
+
+
+def purge_archived_packages(archived_before):
+    """Deletes the summaries archived before `archived_before`; their
+    tracking numbers can then be tracked from scratch. Returns the number
+    of summaries deleted."""
+    count = ArchivedPackage.objects(date_archived__lte=archived_before).delete()
+    if count:
+        log.info('Purged {} archived packages.'.format(count))
+    return count
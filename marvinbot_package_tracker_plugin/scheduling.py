@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from marvinbot_package_tracker_plugin.notifier import TokenBucket
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+SKIP = 'skip'
+COALESCE = 'coalesce'
+
+
+class SingleFlight(object):
+    """Runs `fn` at most once at a time.
+
+    A call made while `fn` is still running returns straight away. With the
+    SKIP policy the call is dropped; with COALESCE every such call is folded
+    into a single rerun as soon as the current run finishes."""
+
+    def __init__(self, fn, name, policy=SKIP):
+        self.fn = fn
+        self.name = name
+        self.policy = policy
+        self.started_at = None
+        self._running = False
+        self._rerun = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        """Returns whether `fn` ran."""
+        with self._lock:
+            if self._running:
+                elapsed = time.monotonic() - self.started_at
+                if self.policy == COALESCE:
+                    self._rerun = True
+                    log.warning('{} still running after {:.0f}s, will run again once it finishes.'.format(self.name, elapsed))
+                else:
+                    log.warning('{} still running after {:.0f}s, skipping this run.'.format(self.name, elapsed))
+                return False
+            self._running = True
+            self.started_at = time.monotonic()
+        try:
+            while True:
+                self.fn()
+                with self._lock:
+                    if not self._rerun:
+                        return True
+                    self._rerun = False
+                    self.started_at = time.monotonic()
+                log.info('Running coalesced {}.'.format(self.name))
+        finally:
+            with self._lock:
+                self._running = False
+                self._rerun = False
+
+
+class Pacer(object):
+    """Blocks callers of `wait` so they proceed at `rate` per second on
+    average, in bursts of at most `burst`. Thread safe."""
+
+    def __init__(self, rate, burst=1):
+        self._bucket = TokenBucket(rate, burst)
+        self._lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                delay = self._bucket.take()
+            if not delay:
+                return
+            time.sleep(delay)
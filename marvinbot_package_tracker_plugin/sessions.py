@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import logging
+import threading
+import requests
+
+log = logging.getLogger(__name__)
+
+
+class SessionPool(object):
+    """Keeps one keep-alive `requests.Session` per courier base URL.
+
+    Sessions are created lazily and shared by every thread, so interactive
+    lookups and the background sweep reuse the same connections."""
+
+    def __init__(self, pool_size=4, connect_timeout=5, read_timeout=15,
+                 max_retries=2, backoff_factor=0.5):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _make_session(self):
+        retry = Retry(total=self.max_retries,
+                      connect=self.max_retries,
+                      read=self.max_retries,
+                      status=self.max_retries,
+                      backoff_factor=self.backoff_factor,
+                      status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def session(self, base_url):
+        with self._lock:
+            session = self._sessions.get(base_url)
+            if session is None:
+                session = self._sessions[base_url] = self._make_session()
+            return session
+
+    def get(self, base_url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(base_url).get(base_url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            session.close()
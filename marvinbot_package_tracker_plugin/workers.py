@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class UserWorkPool(object):
+    """Runs work on behalf of bot users on a shared thread pool, so slow
+    lookups never hold up the bot's update handlers.
+
+    Each user may have at most `max_per_user` jobs in flight."""
+
+    def __init__(self, max_workers=4, max_per_user=2):
+        self.max_per_user = max(1, max_per_user)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self._in_flight = Counter()
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, fn, *args, **kwargs):
+        """Schedules `fn`. Returns its future, or None if `user_id` already has
+        too many jobs in flight."""
+        with self._lock:
+            if self._in_flight[user_id] >= self.max_per_user:
+                return None
+            self._in_flight[user_id] += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._release(user_id)
+            raise
+        future.add_done_callback(lambda f: self._done(user_id, f))
+        return future
+
+    def _release(self, user_id):
+        with self._lock:
+            self._in_flight[user_id] -= 1
+            if self._in_flight[user_id] <= 0:
+                del self._in_flight[user_id]
+
+    def _done(self, user_id, future):
+        self._release(user_id)
+        if not future.cancelled() and future.exception() is not None:
+            err = future.exception()
+            log.error('Background job for user {} failed: {}'.format(user_id, err), exc_info=err)
+
+    def shutdown(self, wait=False):
+        self._executor.shutdown(wait=wait)
@@ -19,9 +19,13 @@ setup(
     author="Ricardo Cabral",
     author_email='ricardo.arturo.cabral@gmail.com',
     url='https://github.com/Cameri/marvinbot_package_tracker_plugin',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'lxml': ['lxml'],
+        'bench': ['mongomock'],
+    },
     license="MIT license",
     zip_safe=False,
     keywords='marvinbot_package_tracker_plugin',
@@ -39,6 +43,7 @@ setup(
         'Programming Language :: Python :: 3.5',
     ],
     test_suite='tests',
+    tests_require=['mongomock'],
     dependency_links=[
         'git+ssh://git@github.com:BotDevGroup/marvin.git#egg=marvinbot',
     ],
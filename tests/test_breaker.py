@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from marvinbot_package_tracker_plugin.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers
+import unittest
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def trip(self, breaker):
+        for _ in range(breaker.failure_threshold):
+            self.assertTrue(breaker.allow())
+            breaker.record(False)
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=60)
+        breaker.record(False)
+        breaker.record(True)
+        self.assertEqual(breaker.failures, 0)
+        self.trip(breaker)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_lets_one_probe_through(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        self.trip(breaker)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_probe_success_closes(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        self.trip(breaker)
+        self.assertTrue(breaker.allow())
+        breaker.record(True)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_probe_failure_reopens(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+        self.trip(breaker)
+        breaker.reset_timeout = 0
+        self.assertTrue(breaker.allow())
+        breaker.reset_timeout = 60
+        breaker.record(False)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertGreater(breaker.snapshot()['retry_in'], 0)
+
+
+class TestCircuitBreakers(unittest.TestCase):
+    def test_one_breaker_per_name(self):
+        breakers = CircuitBreakers(failure_threshold=2)
+        self.assertIs(breakers.get('a'), breakers.get('a'))
+        self.assertIsNot(breakers.get('a'), breakers.get('b'))
+        self.assertEqual(breakers.get('a').failure_threshold, 2)
+        self.assertEqual(set(breakers.snapshot()), {'a', 'b'})
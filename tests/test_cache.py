@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from marvinbot_package_tracker_plugin.cache import LookupCache
+import threading
+import time
+import unittest
+
+
+class TestLookupCache(unittest.TestCase):
+    def test_reuses_fresh_values(self):
+        cache = LookupCache(ttl=60)
+        calls = []
+        for _ in range(3):
+            self.assertEqual(cache.get_or_fetch('key', lambda: calls.append(1) or 'value'), 'value')
+        self.assertEqual(len(calls), 1)
+
+    def test_expired_values_are_fetched_again(self):
+        cache = LookupCache(ttl=0.01)
+        cache.put('key', 'old')
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.get_or_fetch('key', lambda: 'new'), 'new')
+
+    def test_uncacheable_values_are_not_kept(self):
+        cache = LookupCache(ttl=60, cacheable=lambda value: value == 'good')
+        cache.put('a', 'bad')
+        cache.put('b', 'good')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 'good')
+
+    def test_evicts_least_recently_used(self):
+        cache = LookupCache(ttl=60, max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+    def test_coalesces_concurrent_fetches(self):
+        # ttl=0 disables caching, so only coalescing can explain a single call
+        cache = LookupCache(ttl=0)
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch('key', fetch))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 5)
+
+    def test_fetch_errors_reach_every_waiter(self):
+        cache = LookupCache(ttl=60)
+        release = threading.Event()
+
+        def fetch():
+            release.wait(5)
+            raise ValueError('boom')
+
+        errors = []
+
+        def lookup():
+            try:
+                cache.get_or_fetch('key', fetch)
+            except ValueError as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=lookup) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 3)
+        self.assertIsNone(cache.get('key'))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from marvinbot_package_tracker_plugin.fetcher import CourierFetcher
+import threading
+import time
+import unittest
+
+
+class TestCourierFetcher(unittest.TestCase):
+    def test_fetches_every_job(self):
+        fetcher = CourierFetcher(max_workers=4, max_per_courier=2)
+        courier = {'name': 'a'}
+        jobs = [(i, courier, str(i)) for i in range(10)]
+        results = dict(fetcher.fetch_all(jobs, fetch=lambda key, courier, tracking_number: key * 2))
+        self.assertEqual(results, {i: i * 2 for i in range(10)})
+
+    def test_failed_fetches_yield_none(self):
+        fetcher = CourierFetcher()
+
+        def fetch(key, courier, tracking_number):
+            raise ValueError(tracking_number)
+
+        self.assertEqual(list(fetcher.fetch_all([(1, {'name': 'a'}, 'x')], fetch=fetch)), [(1, None)])
+
+    def test_courier_limit_holds_across_concurrent_calls(self):
+        fetcher = CourierFetcher(max_workers=8, max_per_courier=2)
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+
+        def fetch(key, courier, tracking_number):
+            with fetcher.slot(courier['name']):
+                with lock:
+                    active[0] += 1
+                    peak[0] = max(peak[0], active[0])
+                time.sleep(0.01)
+                with lock:
+                    active[0] -= 1
+
+        courier = {'name': 'a'}
+        threads = [threading.Thread(target=lambda: list(fetcher.fetch_all([(i, courier, str(i)) for i in range(6)], fetch=fetch)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(peak[0], 2)
+        self.assertIs(fetcher.slot('a'), fetcher.slot('a'))
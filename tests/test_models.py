@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from marvinbot_package_tracker_plugin.models import SweepLease, TrackedPackage
+from marvinbot_package_tracker_plugin.persistence import BulkWriter
+from datetime import datetime, timedelta
+from unittest import mock
+import mongoengine
+import mongomock
+import mongomock.filtering
+import unittest
+
+
+def mod_op(doc_val, search_val):
+    divisor, remainder = search_val
+    return isinstance(doc_val, int) and doc_val % divisor == remainder
+
+
+class MongoTestCase(unittest.TestCase):
+    def setUp(self):
+        mongoengine.connect('package_tracker_test', mongo_client_class=mongomock.MongoClient)
+        self.addCleanup(mongoengine.disconnect)
+        TrackedPackage.drop_collection()
+        SweepLease.drop_collection()
+
+
+class TestSweepLease(MongoTestCase):
+    def test_only_one_owner_at_a_time(self):
+        self.assertTrue(SweepLease.acquire('shard', 'a', 60))
+        self.assertFalse(SweepLease.acquire('shard', 'b', 60))
+        # Renewing is just acquiring again
+        self.assertTrue(SweepLease.acquire('shard', 'a', 60))
+
+    def test_expired_lease_is_taken_over(self):
+        self.assertTrue(SweepLease.acquire('shard', 'a', 60))
+        SweepLease.objects(id='shard').update(set__expires_at=datetime.now() - timedelta(seconds=1))
+        self.assertTrue(SweepLease.acquire('shard', 'b', 60))
+        self.assertFalse(SweepLease.acquire('shard', 'a', 60))
+
+    def test_count_held_ignores_expired_leases(self):
+        SweepLease.acquire('instance:a', 'a', 60)
+        SweepLease.acquire('instance:b', 'b', 60)
+        SweepLease.acquire('shard', 'a', 60)
+        SweepLease.objects(id='instance:b').update(set__expires_at=datetime.now() - timedelta(seconds=1))
+        self.assertEqual(SweepLease.count_held('instance:'), 1)
+
+    def test_purge_expired_only_deletes_expired_leases_with_the_prefix(self):
+        SweepLease.acquire('instance:a', 'a', 60)
+        SweepLease.acquire('instance:b', 'b', 60)
+        SweepLease.acquire('shard', 'a', 60)
+        SweepLease.objects.update(set__expires_at=datetime.now() - timedelta(seconds=1))
+        SweepLease.acquire('instance:a', 'a', 60)
+        self.assertEqual(SweepLease.purge_expired('instance:'), 1)
+        self.assertEqual(sorted(lease.id for lease in SweepLease.objects), ['instance:a', 'shard'])
+
+    def test_release_only_by_owner(self):
+        SweepLease.acquire('shard', 'a', 60)
+        SweepLease.release('shard', 'b')
+        self.assertFalse(SweepLease.acquire('shard', 'b', 60))
+        SweepLease.release('shard', 'a')
+        self.assertTrue(SweepLease.acquire('shard', 'b', 60))
+
+
+class TestShards(MongoTestCase):
+    def setUp(self):
+        super(TestShards, self).setUp()
+        for n in range(10):
+            TrackedPackage(tracking_number='WR02-{:07d}'.format(n), subscribers=[1]).save()
+        TrackedPackage(tracking_number='WR02-0000010', subscribers=[]).save()
+        self.now = datetime.now()
+        # mongomock has no $mod, so only these tests teach it one
+        patcher = mock.patch.dict(mongomock.filtering._filterer_inst._operator_map, {'$mod': mod_op})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_shard_filters_on_id_modulo(self):
+        query = TrackedPackage.due(self.now, shard=(4, 1))._query
+        self.assertIn({'_id': {'$mod': (4, 1)}}, query['$and'])
+        query = TrackedPackage.due(self.now)._query
+        self.assertFalse(any('_id' in clause for clause in query['$and']))
+
+    def test_shards_partition_the_due_packages(self):
+        due = sorted(tp.id for tp in TrackedPackage.due(self.now))
+        self.assertEqual(len(due), 10)
+        shards = []
+        for index in range(4):
+            ids = [tp.id for tp in TrackedPackage.sweep_batch(self.now, 100, shard=(4, index))]
+            self.assertTrue(all(id % 4 == index for id in ids))
+            self.assertEqual(TrackedPackage.due(self.now, shard=(4, index)).count(), len(ids))
+            shards.extend(ids)
+        self.assertEqual(sorted(shards), due)
+
+
+class TestBulkWriter(MongoTestCase):
+    def setUp(self):
+        super(TestBulkWriter, self).setUp()
+        self.package = TrackedPackage(tracking_number='WR02-0000001', subscribers=[1], num_errors=1)
+        self.package.save()
+
+    def test_merges_updates_to_the_same_document(self):
+        writer = BulkWriter(TrackedPackage)
+        writer.update(self.package.id, set={'courier': 'Aeropaq'}, inc={'num_errors': 1})
+        writer.update(self.package.id, set={'content_hash': 'abc'}, inc={'num_errors': 1},
+                      push={'subscribers': [2]})
+        writer.update(self.package.id, push={'subscribers': [3]})
+        self.assertEqual(writer.flush(), 1)
+        self.package.reload()
+        self.assertEqual(self.package.courier, 'Aeropaq')
+        self.assertEqual(self.package.content_hash, 'abc')
+        # The same field set twice in one batch keeps the last value
+        self.assertEqual(self.package.num_errors, 2)
+        self.assertEqual(self.package.subscribers, [1, 2, 3])
+
+    def test_flushes_when_the_batch_is_full_and_then_runs_callbacks(self):
+        other = TrackedPackage(tracking_number='WR02-0000002', subscribers=[1])
+        other.save()
+        done = []
+        writer = BulkWriter(TrackedPackage, batch_size=2)
+        writer.update(self.package.id, set={'courier': 'Aeropaq'}, then=lambda: done.append(1))
+        self.assertEqual(done, [])
+        writer.update(other.id, set={'courier': 'Aeropaq'}, then=lambda: done.append(2))
+        self.assertEqual(done, [1, 2])
+        self.assertEqual(TrackedPackage.objects(courier='Aeropaq').count(), 2)
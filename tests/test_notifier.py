@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from marvinbot_package_tracker_plugin.notifier import Notifier
+import threading
+import unittest
+
+
+class RetryAfter(Exception):
+    def __init__(self, retry_after):
+        super(RetryAfter, self).__init__('Retry in {}s'.format(retry_after))
+        self.retry_after = retry_after
+
+
+class TestNotifier(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def send(self, chat_id, text, **kwargs):
+        with self.lock:
+            if self.failures.get(text):
+                self.failures[text] -= 1
+                raise RetryAfter(0.01)
+            self.sent.append((chat_id, text))
+
+    def notifier(self, **kwargs):
+        notifier = Notifier(self.send, rate=1000, chat_interval=0, **kwargs)
+        self.addCleanup(notifier.stop)
+        return notifier
+
+    def test_delivers_in_order_per_chat(self):
+        notifier = self.notifier()
+        for i in range(5):
+            notifier.notify(1, 'message {}'.format(i))
+        self.assertTrue(notifier.drain(5))
+        self.assertEqual(self.sent, [(1, 'message {}'.format(i)) for i in range(5)])
+
+    def test_skips_duplicates_while_pending(self):
+        notifier = self.notifier()
+        # Hold the worker so every message is still pending
+        with self.lock:
+            self.assertTrue(notifier.notify(1, 'first'))
+            self.assertTrue(notifier.notify(1, 'same'))
+            self.assertFalse(notifier.notify(1, 'same'))
+            self.assertTrue(notifier.notify(2, 'same'))
+        self.assertTrue(notifier.drain(5))
+        self.assertEqual(sorted(self.sent), [(1, 'first'), (1, 'same'), (2, 'same')])
+
+    def test_retries_rate_limited_sends(self):
+        notifier = self.notifier(max_attempts=5)
+        self.failures['limited'] = 2
+        notifier.notify(1, 'limited')
+        self.assertTrue(notifier.drain(5))
+        self.assertEqual(self.sent, [(1, 'limited')])
+
+    def test_gives_up_after_max_attempts(self):
+        notifier = self.notifier(max_attempts=2)
+        self.failures['limited'] = 5
+        notifier.notify(1, 'limited')
+        notifier.notify(1, 'after')
+        self.assertTrue(notifier.drain(5))
+        self.assertEqual(self.sent, [(1, 'after')])
+        self.assertEqual(self.failures['limited'], 3)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from marvinbot_package_tracker_plugin.parsers import HAS_LXML, PARSERS, format_events
+from benchmarks import fixture
+from benchmarks.bench_parsers import CASES, CONFIG
+import unittest
+
+
+class TestParsers(unittest.TestCase):
+    def check(self, backend):
+        config = dict(CONFIG, html_parser=backend)
+        for parser_name, page, expected in CASES:
+            with self.subTest(parser=parser_name, page=page):
+                events = PARSERS[parser_name](fixture(page), config)
+                self.assertEqual(format_events(events, config), fixture(expected).rstrip('\n'))
+
+    def test_html_parser(self):
+        self.check('html.parser')
+
+    @unittest.skipUnless(HAS_LXML, 'lxml is not installed')
+    def test_lxml(self):
+        self.check('lxml')
+
+    def test_events_have_every_field(self):
+        events = PARSERS['labels'](fixture('labels.html'), dict(CONFIG, html_parser='html.parser'))
+        self.assertTrue(events)
+        for event in events:
+            self.assertEqual(set(event), {'status', 'date', 'time', 'location'})
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from marvinbot_package_tracker_plugin.base import (INSTANCE_LEASE_PREFIX, SKIPPED, UNCHANGED, PackageTrackerPlugin,
+                                                   compact_tracked_packages, new_events, process_tracked_packages)
+from marvinbot_package_tracker_plugin.models import SweepCheckpoint, SweepLease, TrackedPackage, TrackingEvent
+from marvinbot_package_tracker_plugin.parsers import format_event
+from datetime import datetime, timedelta
+from unittest import mock
+import mongoengine
+import mongomock
+import unittest
+
+TRACKING_NUMBER = 'WR02-0000001'
+
+A = {'status': 'Recibido', 'date': '01-03-2017', 'time': '10:00 AM', 'location': 'MIAMI'}
+B = {'status': 'En transito', 'date': '02-03-2017', 'time': '11:00 AM', 'location': None}
+C = {'status': 'Entregado', 'date': '03-03-2017', 'time': '12:00 PM', 'location': 'SANTO DOMINGO'}
+
+
+class RecordingNotifier(object):
+    def __init__(self):
+        self.sent = []
+
+    def notify(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return True
+
+    def stop(self):
+        pass
+
+
+class SweepTestCase(unittest.TestCase):
+    def setUp(self):
+        mongoengine.connect('package_tracker_test', mongo_client_class=mongomock.MongoClient)
+        self.addCleanup(mongoengine.disconnect)
+        for document_cls in (TrackedPackage, SweepCheckpoint, SweepLease):
+            document_cls.drop_collection()
+
+        self.plugin = PackageTrackerPlugin()
+        config = self.plugin.get_default_config()
+        # mongomock has no $mod, so sweep a single shard, at full speed
+        config.update({'sweep_shards': 1, 'sweep_spread': 0, 'metrics_sinks': []})
+        self.plugin.configure(config)
+        self.plugin.notifier.stop()
+        self.plugin.notifier = RecordingNotifier()
+        self.addCleanup(self.plugin.workers.shutdown)
+        self.addCleanup(self.plugin.release_instance_lease)
+        process_tracked_packages.plugin = self.plugin
+        self.outcome = None
+        self.plugin.check_courier = lambda courier, trackedPackage: self.outcome
+
+    def package(self, **fields):
+        package = TrackedPackage(tracking_number=TRACKING_NUMBER, courier='Aeropaq', subscribers=[1], **fields)
+        package.save()
+        return package
+
+    def sweep(self, events, validators=None, status=200):
+        self.outcome = [events, status, validators or {}]
+        TrackedPackage.objects.update(set__next_check_at=None)
+        process_tracked_packages()
+        return TrackedPackage.objects.get(tracking_number=TRACKING_NUMBER)
+
+    def format(self, *events):
+        return [format_event(event, self.plugin.config) for event in events]
+
+
+class TestNewEvents(SweepTestCase):
+    def test_only_unstored_events_are_new(self):
+        package = TrackedPackage(events=[TrackingEvent(**A), TrackingEvent(**B)])
+        self.assertEqual(new_events(package, [A, B, C], self.plugin.config), ([C], [C]))
+
+    def test_legacy_updates_are_stored_but_not_sent_again(self):
+        package = TrackedPackage(updates='\n'.join(self.format(A, B)))
+        self.assertEqual(new_events(package, [A, B, C], self.plugin.config), ([A, B, C], [C]))
+
+
+class TestSweepNotifications(SweepTestCase):
+    def test_notifies_only_new_events(self):
+        self.package(events=[TrackingEvent(**A)], num_events=1)
+        package = self.sweep([A, B, C], {'content_hash': 'page'})
+        self.assertEqual(len(self.plugin.notifier.sent), 1)
+        self.assertNotIn(self.format(A)[0], self.plugin.notifier.sent[0][1])
+        self.assertIn(self.format(C)[0], self.plugin.notifier.sent[0][1])
+        self.assertEqual([event.to_event() for event in package.events], [A, B, C])
+        self.assertEqual(package.num_events, 3)
+
+    def test_migrates_legacy_updates_without_resending_them(self):
+        self.package(updates='\n'.join(self.format(A, B)))
+        package = self.sweep([A, B, C], {'content_hash': 'page'})
+        self.assertEqual(len(self.plugin.notifier.sent), 1)
+        self.assertNotIn(self.format(B)[0], self.plugin.notifier.sent[0][1])
+        self.assertEqual([event.to_event() for event in package.events], [A, B, C])
+        self.assertIsNone(package.updates)
+
+        # Stored now, so the same page is news to nobody
+        self.sweep([A, B, C], {'content_hash': 'page'})
+        self.assertEqual(len(self.plugin.notifier.sent), 1)
+
+    def test_no_renotify_after_a_cached_lookup_clears_the_fingerprint(self):
+        self.package(events=[TrackingEvent(**A)], num_events=1, content_hash='old')
+        # Results reused from an interactive /track come without validators
+        package = self.sweep([A, B])
+        self.assertEqual(len(self.plugin.notifier.sent), 1)
+        self.assertIsNone(package.content_hash)
+
+        # The next fetch can't match the cleared fingerprint, so it is parsed again
+        package = self.sweep([A, B], {'content_hash': 'page'})
+        self.assertEqual(len(self.plugin.notifier.sent), 1)
+        self.assertEqual(package.content_hash, 'page')
+        self.assertEqual(len(package.events), 2)
+
+
+class TestSweepReads(SweepTestCase):
+    def event_loads(self, events, status=200):
+        """Runs a sweep and returns how many queries loaded stored events."""
+        find = mongomock.collection.Collection.find
+        projections = []
+
+        def spy(collection, *args, **kwargs):
+            projections.append(kwargs.get('projection') or (args[1] if len(args) > 1 else None))
+            return find(collection, *args, **kwargs)
+
+        with mock.patch.object(mongomock.collection.Collection, 'find', spy):
+            self.sweep(events, status=status)
+        return sum(1 for projection in projections if projection and 'events' in projection)
+
+    def test_parsed_pages_load_stored_events(self):
+        self.package(events=[TrackingEvent(**A)], num_events=1)
+        self.assertEqual(self.event_loads([A, B]), 1)
+
+    def test_skipped_unchanged_and_failed_lookups_load_nothing(self):
+        self.package(events=[TrackingEvent(**A)], num_events=1)
+        self.assertEqual(self.event_loads(SKIPPED, status=None), 0)
+        self.assertEqual(self.event_loads(UNCHANGED), 0)
+        self.assertEqual(self.event_loads(None, status=500), 0)
+        self.assertEqual(self.plugin.notifier.sent, [])
+
+
+class TestInstanceLease(SweepTestCase):
+    def test_sweeping_announces_the_instance_until_reconfigured(self):
+        self.package()
+        self.sweep([A])
+        self.assertEqual(SweepLease.count_held(INSTANCE_LEASE_PREFIX), 1)
+        self.plugin.configure(self.plugin.config)
+        self.plugin.notifier.stop()
+        self.assertEqual(SweepLease.count_held(INSTANCE_LEASE_PREFIX), 0)
+
+    def test_compaction_deletes_leases_of_stopped_instances(self):
+        compact_tracked_packages.plugin = self.plugin
+        SweepLease.acquire(INSTANCE_LEASE_PREFIX + 'gone', 'gone', 60)
+        SweepLease.acquire(INSTANCE_LEASE_PREFIX + 'alive', 'alive', 60)
+        SweepLease.objects(id=INSTANCE_LEASE_PREFIX + 'gone').update(set__expires_at=datetime.now() - timedelta(seconds=1))
+        compact_tracked_packages()
+        self.assertEqual([lease.id for lease in SweepLease.objects], [INSTANCE_LEASE_PREFIX + 'alive'])